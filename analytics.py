@@ -0,0 +1,229 @@
+import argparse
+import bisect
+import itertools
+import json
+from collections import Counter
+from functools import lru_cache
+from typing import AbstractSet, Dict, Iterable, List, Mapping, Optional, Sequence, Set, Tuple
+
+from char_store import get_store
+from character_lists import get_all_lists, get_characters_in_list
+from ingest import CHUNK_SIZE, ingest_paths, iter_text_files
+from instrumentation import metrics
+from scheduler import get_scheduler
+
+# Same block as processor.is_chinese_char
+CJK_START = 0x4E00
+CJK_END = 0x9FFF
+DEFAULT_COVERAGE_TARGETS = (0.5, 0.8, 0.9, 0.95, 0.98, 0.99)
+
+
+@lru_cache(maxsize=1)
+def _numpy():
+    """NumPy if it is installed, imported on first use because importing it takes ~100 ms"""
+    try:
+        import numpy
+    except ImportError:  # Counter-based counting is used instead
+        return None
+    return numpy
+
+
+class CharCounter:
+    """Accumulates Chinese character counts over any number of text chunks
+
+    With NumPy the chunk is viewed as UTF-32 code points and counted with one
+    bincount over the CJK block; otherwise chunks are merged into a Counter.
+    """
+
+    def __init__(self, use_numpy: Optional[bool] = None):
+        self._np = _numpy() if use_numpy is not False else None
+        self.use_numpy = self._np is not None
+        self.total_chars = 0
+        if self.use_numpy:
+            self._bins = self._np.zeros(CJK_END - CJK_START + 1, dtype=self._np.int64)
+        else:
+            self._counter = Counter()
+
+    def add(self, text: str) -> None:
+        self.total_chars += len(text)
+        if self.use_numpy:
+            codes = self._np.frombuffer(text.encode('utf-32-le'), dtype='<u4')
+            codes = codes[(codes >= CJK_START) & (codes <= CJK_END)] - CJK_START
+            self._bins += self._np.bincount(codes, minlength=len(self._bins))
+        else:
+            self._counter.update(text)
+
+    def counts(self) -> Dict[str, int]:
+        if self.use_numpy:
+            nonzero = self._np.flatnonzero(self._bins)
+            return {chr(CJK_START + int(i)): int(self._bins[i]) for i in nonzero}
+        return {char: count for char, count in self._counter.items()
+                if CJK_START <= ord(char) <= CJK_END}
+
+
+def count_chars(text: str) -> Dict[str, int]:
+    """Count the Chinese characters in a text"""
+    counter = CharCounter()
+    counter.add(text)
+    return counter.counts()
+
+
+def count_chars_in_files(paths: Iterable[str], chunk_size: int = CHUNK_SIZE) -> Tuple[Dict[str, int], int, int]:
+    """Count Chinese characters across files or directories in bounded chunks
+
+    Returns the counts, the number of characters read and the number of files
+    """
+    counter = CharCounter()
+    files = 0
+    with metrics.timer('analytics.count_chars'):
+        for path in iter_text_files(paths):
+            files += 1
+            with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                for block in iter(lambda: f.read(chunk_size), ''):
+                    counter.add(block)
+    metrics.incr('analytics.chars_counted', counter.total_chars)
+    return counter.counts(), counter.total_chars, files
+
+
+class FrequencyTable:
+    """Items ranked from most to least frequent with their cumulative coverage"""
+
+    def __init__(self, counts: Mapping[str, int]):
+        ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        self.items = [item for item, _ in ranked]
+        self.counts = [count for _, count in ranked]
+        self._cumulative = list(itertools.accumulate(self.counts))
+        self.total = self._cumulative[-1] if self._cumulative else 0
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def top(self, n: int) -> List[Tuple[str, int, float]]:
+        """The n most frequent items with their counts and the coverage reached at each rank"""
+        return [(item, count, self.coverage_at(rank + 1))
+                for rank, (item, count) in enumerate(zip(self.items[:n], self.counts[:n]))]
+
+    def coverage_at(self, size: int) -> float:
+        """Fraction of all occurrences covered by the size most frequent items"""
+        if not self.total or size <= 0:
+            return 0.0
+        return self._cumulative[min(size, len(self._cumulative)) - 1] / self.total
+
+    def size_for_coverage(self, fraction: float) -> int:
+        """How many of the most frequent items are needed to cover fraction of all occurrences"""
+        if not self.total:
+            return 0
+        return min(bisect.bisect_left(self._cumulative, fraction * self.total) + 1, len(self.items))
+
+    def curve(self, targets: Sequence[float] = DEFAULT_COVERAGE_TARGETS) -> List[Tuple[float, int]]:
+        return [(target, self.size_for_coverage(target)) for target in targets]
+
+    def coverage_of(self, known: Set[str]) -> float:
+        """Fraction of all occurrences that are items in known"""
+        if not self.total:
+            return 0.0
+        return sum(count for item, count in zip(self.items, self.counts) if item in known) / self.total
+
+    def top_unknown(self, known: Set[str], n: int) -> List[Tuple[str, int]]:
+        """The n most frequent items not in known, i.e. what to learn next"""
+        return list(itertools.islice(
+            ((item, count) for item, count in zip(self.items, self.counts) if item not in known), n))
+
+
+def known_characters(source: str) -> AbstractSet[str]:
+    """Characters considered known: 'store' (every stored character), 'reviewed'
+    (passed at least once in flashcards) or the name of a character list"""
+    if source == 'store':
+        return set(get_store().keys())
+    if source == 'reviewed':
+        # The scheduler's own states already include reviews not written to the store yet
+        return get_scheduler().reviewed()
+    if source not in get_all_lists():
+        raise ValueError(f"Unknown character list: {source}")
+    return set(get_characters_in_list(source))
+
+
+def build_report(chars: FrequencyTable, words: Optional[FrequencyTable], known: Optional[Set[str]],
+                 top: int, targets: Sequence[float]) -> Dict:
+    report = {
+        'total_chinese_chars': chars.total,
+        'distinct_chars': len(chars),
+        'char_coverage': [{'coverage': target, 'chars': size} for target, size in chars.curve(targets)],
+        'top_chars': [{'char': char, 'count': count, 'cumulative': cumulative}
+                      for char, count, cumulative in chars.top(top)],
+    }
+    if known is not None:
+        report['known_chars'] = len(known)
+        report['known_coverage'] = chars.coverage_of(known)
+        report['learn_next'] = [{'char': char, 'count': count} for char, count in chars.top_unknown(known, top)]
+    if words is not None:
+        report['total_words'] = words.total
+        report['distinct_words'] = len(words)
+        report['word_coverage'] = [{'coverage': target, 'words': size} for target, size in words.curve(targets)]
+        report['top_words'] = [{'word': word, 'count': count, 'cumulative': cumulative}
+                               for word, count, cumulative in words.top(top)]
+    return report
+
+
+def format_report(report: Dict) -> str:
+    lines = [f"{report['total_chinese_chars']:,} Chinese characters, {report['distinct_chars']:,} distinct"]
+    lines.append("Characters needed for coverage:")
+    lines.extend(f"  {entry['coverage']:>6.0%}  {entry['chars']:>7,}" for entry in report['char_coverage'])
+    if 'known_coverage' in report:
+        lines.append(f"Known characters ({report['known_chars']:,}) cover {report['known_coverage']:.1%} of the text")
+        lines.append("Most frequent unknown characters: "
+                     + (' '.join(f"{entry['char']}({entry['count']:,})" for entry in report['learn_next']) or "none"))
+    lines.append("Most frequent characters:")
+    lines.extend(f"  {rank:>5}  {entry['char']}  {entry['count']:>12,}  {entry['cumulative']:6.1%}"
+                 for rank, entry in enumerate(report['top_chars'], start=1))
+    if 'top_words' in report:
+        lines.append(f"{report['total_words']:,} words, {report['distinct_words']:,} distinct")
+        lines.append("Words needed for coverage:")
+        lines.extend(f"  {entry['coverage']:>6.0%}  {entry['words']:>7,}" for entry in report['word_coverage'])
+        lines.append("Most frequent words:")
+        lines.extend(f"  {rank:>5}  {entry['word']}  {entry['count']:>12,}  {entry['cumulative']:6.1%}"
+                     for rank, entry in enumerate(report['top_words'], start=1))
+    return '\n'.join(lines)
+
+
+def _parse_targets(value: str) -> List[float]:
+    return [float(target) for target in value.split(',') if target]
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Character and word frequency and coverage report for a corpus")
+    parser.add_argument("paths", nargs="+", help="files or directories to analyze")
+    parser.add_argument("--top", type=int, default=50, help="how many of the most frequent items to list")
+    parser.add_argument("--coverage", type=_parse_targets, default=list(DEFAULT_COVERAGE_TARGETS),
+                        help="comma-separated coverage targets, e.g. 0.9,0.95,0.99")
+    parser.add_argument("--known", default="store",
+                        help="known characters: 'store', 'reviewed', a list name, or 'none'")
+    parser.add_argument("--words", action="store_true",
+                        help="also segment the corpus and report word frequencies (slower)")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes for --words")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--json", dest="json_out", help="also write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    try:
+        counts, total, files = count_chars_in_files(args.paths, args.chunk_size)
+        known = None if args.known == 'none' else known_characters(args.known)
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Error: {e}")
+        return
+    words = None
+    if args.words:
+        words = FrequencyTable(ingest_paths(args.paths, workers=args.workers, chunk_size=args.chunk_size).word_counts)
+
+    report = build_report(FrequencyTable(counts), words, known, args.top, args.coverage)
+    report['files'] = files
+    report['total_chars'] = total
+    print(f"Read {total:,} characters from {files} files" + (" (NumPy)" if _numpy() is not None else ""))
+    print(format_report(report))
+    if args.json_out:
+        with open(args.json_out, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
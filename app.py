@@ -1,88 +1,195 @@
 import streamlit as st
-import json
-from processor import process_chinese_text, load_chars_json
-from pypinyin import pinyin, Style
-from PIL import Image
-import pytesseract
-import random
+from processor import (
+    process_chinese_text, segment_text, count_words, summarize_chars, all_compounds, compound_page,
+    search_dictionary
+)
+from cedict_index import CEDICT_FILE, get_index
+from char_store import get_store
+from compound_matcher import get_matcher
+from file_utils import file_signature
+from ocr import MAX_DIMENSION, ocr_images
+from pinyin_engine import full_pinyin
+from instrumentation import export_if_configured, metrics
+from scheduler import GRADES, get_scheduler
+from deck import CharTable, build_list_ids
+from analytics import FrequencyTable, known_characters
+from reverse_search import get_search_index
+import time
 from character_lists import (
-    load_character_lists, add_to_list, remove_from_list,
+    LISTS_FILE, load_character_lists, add_to_list, remove_from_list,
     create_list, delete_list, get_characters_in_list, get_all_lists
 )
 
-# Configure pytesseract to use the installed Tesseract executable
-pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+# Cards each session keeps at hand; the rest of the deck stays in the shared due queue
+REVIEW_WINDOW = 20
+# Dictionary compounds shown per page when browsing all of them
+COMPOUND_PAGE_SIZE = 10
+# Characters per page in the Details View
+DETAILS_PAGE_SIZE = 50
+# Dictionary search results shown at once
+SEARCH_LIMIT = 50
+SEARCH_MODES = {"Auto": "auto", "English": "english", "Pinyin": "pinyin"}
+
+@st.cache_resource(max_entries=1, show_spinner="Loading dictionary...")
+def load_dictionary(signature):
+    """Warm the CEDICT index and compound matcher once for every session in this process"""
+    # signature is the dictionary file's stat, so editing the file evicts this entry
+    index = get_index()
+    matcher = get_matcher(index) if index is not None else None
+    # Builds the search index on first start; later starts only map the file
+    get_search_index()
+    return index, matcher
+
+@st.cache_resource
+def load_store():
+    """Open the character store shared by all sessions"""
+    return get_store()
+
+@st.cache_resource(max_entries=1)
+def load_char_table(version):
+    """Table of every stored character shared by all sessions, rebuilt when the store's version changes"""
+    return CharTable.from_store(load_store())
+
+def get_char_table():
+    return load_char_table(load_store().version())
 
+@st.cache_resource(max_entries=1)
+def load_list_ids(table_version, lists_signature):
+    """Member IDs of every character list, recomputed when the table or the lists file changes"""
+    return build_list_ids(get_char_table(), load_character_lists())
+
+def get_list_ids(list_name: str):
+    list_ids = load_list_ids(load_store().version(), file_signature(LISTS_FILE))
+    return list_ids.get(list_name, get_char_table().ids(()))
+
+@st.cache_data(max_entries=128, show_spinner=False)
 def get_full_pinyin(text: str) -> str:
-    # Get pinyin with tone marks
-    result = pinyin(text, style=Style.TONE)
-    # Flatten the list and join with spaces
-    return ' '.join([item[0] for item in result])
-
-def extract_text_from_image(image):
-    try:
-        # Use pytesseract to do OCR on the image
-        text = pytesseract.image_to_string(image, lang='chi_sim')
-        return text.strip()
-    except Exception as e:
-        st.error(f"Error processing image: {str(e)}")
-        return ""
+    # Context-aware, table-driven pinyin with tone marks
+    return full_pinyin(text)
+
+def extract_text_from_images(uploaded_files, downscale: bool, binarize: bool) -> str:
+    """OCR a batch of uploaded images and join their text in upload order"""
+    results = ocr_images(
+        [uploaded_file.getvalue() for uploaded_file in uploaded_files],
+        max_dimension=MAX_DIMENSION if downscale else None,
+        binarize=binarize,
+    )
+    texts = []
+    for uploaded_file, result in zip(uploaded_files, results):
+        if result.error:
+            st.error(f"Error processing image {uploaded_file.name}: {result.error}")
+        elif result.text:
+            texts.append(result.text)
+    cached = sum(result.cached for result in results)
+    if cached:
+        st.caption(f"{cached} of {len(results)} images loaded from the OCR cache")
+    return '\n'.join(texts)
+
+def render_all_compounds(char: str, key: str):
+    """Browse every dictionary compound of char one page at a time, looked up only when opened"""
+    total = len(all_compounds(char))
+    if not total or not st.toggle(f"Browse all {total} dictionary compounds", key=f"all_compounds_{key}"):
+        return
+    pages = (total + COMPOUND_PAGE_SIZE - 1) // COMPOUND_PAGE_SIZE
+    page = 1
+    if pages > 1:
+        page = st.number_input("Page", min_value=1, max_value=pages, value=1, key=f"compound_page_{key}")
+    st.markdown('\n'.join(f"- **{compound['word']}**: {compound['meaning']}"
+                           for compound in compound_page(char, page - 1, COMPOUND_PAGE_SIZE)))
+    st.caption(f"Page {page} of {pages}, most frequent first")
 
 def initialize_flashcard_state():
-    if 'current_char_index' not in st.session_state:
-        st.session_state.current_char_index = 0
+    if 'review_window' not in st.session_state:
+        st.session_state.review_window = None  # Card IDs, filled from the due queue on first render
+    if 'reviewed_count' not in st.session_state:
+        st.session_state.reviewed_count = 0
     if 'show_answer' not in st.session_state:
         st.session_state.show_answer = False
-    if 'flashcard_chars' not in st.session_state:
-        # Load all characters from JSON at initialization
-        chars_dict = load_chars_json()
-        st.session_state.flashcard_chars = [(char, info) for char, info in chars_dict.items()]
-        random.shuffle(st.session_state.flashcard_chars)  # Shuffle initially
     if 'selected_list' not in st.session_state:
         st.session_state.selected_list = "All Characters"
     if 'new_list_name' not in st.session_state:
         st.session_state.new_list_name = ""
 
-def filter_flashcards_by_list(list_name: str):
-    """Filter flashcards based on selected list"""
-    chars_dict = load_chars_json()
+@st.cache_resource(max_entries=8)
+def load_due_queue(list_name, version):
+    """Due queue for a deck shared by every session, rebuilt when the deck's contents change"""
+    table = get_char_table()
+    ids = table.all_ids() if list_name == "All Characters" else get_list_ids(list_name)
+    return get_scheduler().queue(table, ids)
+
+def get_due_queue():
+    list_name = st.session_state.selected_list
+    store_version = load_store().version()
     if list_name == "All Characters":
-        st.session_state.flashcard_chars = [(char, info) for char, info in chars_dict.items()]
-    else:
-        char_set = get_characters_in_list(list_name)
-        st.session_state.flashcard_chars = [(char, info) for char, info in chars_dict.items() if char in char_set]
-    if st.session_state.flashcard_chars:
-        random.shuffle(st.session_state.flashcard_chars)
-        st.session_state.current_char_index = 0
-        st.session_state.show_answer = False
+        return load_due_queue(list_name, store_version)
+    return load_due_queue(list_name, (store_version, file_signature(LISTS_FILE)))
 
-def next_flashcard():
-    st.session_state.current_char_index = (st.session_state.current_char_index + 1) % len(st.session_state.flashcard_chars)
+def refill_review_window(ahead: bool = False):
+    st.session_state.review_window = get_due_queue().window(REVIEW_WINDOW, ahead=ahead)
     st.session_state.show_answer = False
 
-def previous_flashcard():
-    st.session_state.current_char_index = (st.session_state.current_char_index - 1) % len(st.session_state.flashcard_chars)
+def filter_flashcards_by_list(list_name: str):
+    """Switch the review window to the selected list"""
+    st.session_state.selected_list = list_name
+    refill_review_window()
+
+def grade_flashcard(grade: int):
+    """Record how well the current card was recalled and move on to the next one"""
+    window = st.session_state.review_window
+    card_id = window.pop(0)
+    get_scheduler().review(get_char_table()[card_id], grade)
+    get_due_queue().push(card_id)
+    st.session_state.reviewed_count += 1
+    st.session_state.show_answer = False
+    if not window:
+        refill_review_window()
+
+def skip_flashcard():
+    window = st.session_state.review_window
+    window.append(window.pop(0))
     st.session_state.show_answer = False
 
 def toggle_answer():
     st.session_state.show_answer = not st.session_state.show_answer
 
-def shuffle_flashcards():
-    random.shuffle(st.session_state.flashcard_chars)
-    st.session_state.current_char_index = 0
-    st.session_state.show_answer = False
+def render_diagnostics():
+    """Optional sidebar panel with the process-wide timings and counters"""
+    if not st.sidebar.checkbox("Show diagnostics"):
+        return
+    snapshot = metrics.snapshot()
+    st.sidebar.subheader("Stage timings")
+    st.sidebar.dataframe([
+        {"Stage": name, "Calls": stats["count"],
+         "Total (ms)": round(stats["total_seconds"] * 1000, 2),
+         "Max (ms)": round(stats["max_seconds"] * 1000, 2)}
+        for name, stats in sorted(snapshot["timers"].items())
+    ])
+    st.sidebar.subheader("Counters")
+    st.sidebar.dataframe([
+        {"Counter": name, "Value": value} for name, value in sorted(snapshot["counters"].items())
+    ])
+    for name, value in sorted(snapshot["gauges"].items()):
+        st.sidebar.write(f"**{name}:** {value}")
+    st.sidebar.download_button("Download metrics (JSON lines)", metrics.to_jsonl(source="app"),
+                               file_name="metrics.jsonl")
+    if st.sidebar.button("Reset metrics"):
+        metrics.reset()
 
 def main():
     st.title("Chinese Character Analysis Tool")
     st.write("Enter Chinese text to analyze characters and find their meanings, pinyin, and compound words.")
 
+    # Warm the shared dictionary before any session needs it
+    load_dictionary(file_signature(CEDICT_FILE))
+
     # Initialize session state for flashcards
     initialize_flashcard_state()
 
     # Create tabs for different sections
-    main_tab1, main_tab2, main_tab3 = st.tabs(["Text Analysis", "Flashcards", "Character Lists"])
+    main_tab1, main_tab2, main_tab3, main_tab4 = st.tabs(
+        ["Text Analysis", "Flashcards", "Character Lists", "Dictionary Search"])
 
-    with main_tab1:
+    with main_tab1, metrics.timer('render.analysis'):
         # Create tabs for input methods
         input_tab1, input_tab2 = st.tabs(["Text Input", "Image Upload"])
 
@@ -92,12 +199,16 @@ def main():
             process_button = st.button("Process Text")
             
         with input_tab2:
-            uploaded_file = st.file_uploader("Choose an image file", type=['png', 'jpg', 'jpeg'])
-            if uploaded_file is not None:
-                image = Image.open(uploaded_file)
-                st.image(image, caption='Uploaded Image', use_column_width=True)
-                if st.button("Extract Text from Image"):
-                    text_input = extract_text_from_image(image)
+            uploaded_files = st.file_uploader(
+                "Choose image files", type=['png', 'jpg', 'jpeg'], accept_multiple_files=True
+            )
+            if uploaded_files:
+                st.image([uploaded_file.getvalue() for uploaded_file in uploaded_files],
+                         caption=[uploaded_file.name for uploaded_file in uploaded_files], width=150)
+                downscale = st.checkbox("Downscale large images", value=True)
+                binarize = st.checkbox("Convert to black and white before OCR")
+                if st.button("Extract Text from Images"):
+                    text_input = extract_text_from_images(uploaded_files, downscale, binarize)
                     st.write("Extracted text:")
                     st.write(text_input)
                     process_button = True
@@ -105,80 +216,152 @@ def main():
         if process_button and text_input and text_input.strip():
             # Process the text
             process_chinese_text(text_input)
+            export_if_configured(source="app")
             
-            # Load and display results
-            chars_dict = load_chars_json()
+            # One summary per input; results are rendered from it on every rerun until the next input
+            st.session_state.analysis = {
+                "text": text_input,
+                "chars": summarize_chars(text_input),
+                "words": count_words(segment_text(text_input)),
+            }
+            st.session_state.pop("details_page", None)
+        elif process_button:
+            st.warning("Please enter some Chinese text to process.")
+
+        analysis = st.session_state.get("analysis")
+        if analysis:
+            analyzed_text = analysis["text"]
+            char_counts = analysis["chars"]
+            # Load entries for the unique characters of the input only
+            chars_dict = load_store().get_many(char_counts)
             
             st.subheader("Analysis Results")
+            st.caption(f"{len(analyzed_text)} characters, {sum(char_counts.values())} Chinese, "
+                       f"{len(char_counts)} unique")
             
             # Create tabs for different views
-            tab1, tab2, tab3 = st.tabs(["Full Pinyin", "Character List", "Details View"])
+            tab1, tab2, tab_words, tab_freq, tab3 = st.tabs(
+                ["Full Pinyin", "Character List", "Words", "Frequency", "Details View"])
             
             with tab1:
                 # Show complete pinyin for the entire text
                 st.subheader("Complete Pinyin")
                 st.write("Original text:")
-                st.write(text_input)
+                st.write(analyzed_text)
                 st.write("Pinyin:")
-                full_pinyin = get_full_pinyin(text_input)
+                full_pinyin = get_full_pinyin(analyzed_text)
                 st.write(full_pinyin)
             
             with tab2:
-                # Display as a table
+                # Display as a table, one row per unique character in order of appearance
                 data = []
-                for char, info in chars_dict.items():
-                    if char in text_input:  # Only show characters from input
+                for char, count in char_counts.items():
+                    info = chars_dict.get(char)
+                    if info:
                         data.append({
                             "Character": char,
                             "Pinyin": info["pinyin"],
-                            "Meaning": info["meaning"]
+                            "Meaning": info["meaning"],
+                            "Count": count
                         })
                 if data:
                     st.dataframe(data)
                 else:
                     st.info("No Chinese characters found in the input text.")
             
-            with tab3:
-                # Detailed view with compounds
-                for char in text_input:
-                    if char in chars_dict and '\u4e00' <= char <= '\u9fff':
-                        info = chars_dict[char]
-                        with st.expander(f"{char} ({info['pinyin']})"):
-                            st.write("**Meaning:**", info["meaning"])
-                            
-                            if info["compounds"]:
-                                st.write("**Compound Words:**")
-                                for compound in info["compounds"]:
-                                    st.write(f"- {compound['word']}: {compound['meaning']}")
-        elif process_button:
-            st.warning("Please enter some Chinese text to process.")
-
-    with main_tab2:
-        if st.session_state.flashcard_chars:
-            # Add list selection dropdown
-            all_lists = ["All Characters"] + get_all_lists()
-            selected_list = st.selectbox(
-                "Select Character List",
-                all_lists,
-                index=all_lists.index(st.session_state.selected_list)
-            )
+            with tab_words:
+                # Word-by-word breakdown from the segmenter
+                word_counts = analysis["words"]
+                words_dict = load_store().get_words(word_counts)
+                data = []
+                for word, count in word_counts.items():
+                    info = words_dict.get(word)
+                    if info:
+                        data.append({
+                            "Word": word,
+                            "Pinyin": info["pinyin"],
+                            "Meaning": info["meaning"],
+                            "Count": count
+                        })
+                if data:
+                    st.dataframe(data)
+                else:
+                    st.info("No dictionary words found in the input text.")
             
-            if selected_list != st.session_state.selected_list:
-                st.session_state.selected_list = selected_list
-                filter_flashcards_by_list(selected_list)
-
-            st.write(f"Practice with characters from: {selected_list}")
+            with tab_freq:
+                # Which characters of this text are worth learning first
+                frequencies = FrequencyTable(char_counts)
+                if not len(frequencies):
+                    st.info("No Chinese characters found in the input text.")
+                else:
+                    st.write(f"{frequencies.total} Chinese characters, {len(frequencies)} distinct")
+                    st.write("Characters needed to cover the text:")
+                    st.dataframe([{"Coverage": f"{target:.0%}", "Characters": size}
+                                  for target, size in frequencies.curve()])
+                    st.write("Coverage by what you know:")
+                    st.dataframe([{"Known characters": source,
+                                   "Count": len(known),
+                                   "Coverage": f"{frequencies.coverage_of(known):.1%}"}
+                                  for source, known in [("Reviewed in flashcards", known_characters('reviewed'))]
+                                  + [(f"List: {name}", known_characters(name)) for name in get_all_lists()]])
+                    st.write("Most frequent characters:")
+                    st.dataframe([{"Character": char, "Count": count, "Cumulative": f"{cumulative:.1%}"}
+                                  for char, count, cumulative in frequencies.top(50)])
             
-            col1, col2, col3 = st.columns([1, 2, 1])
-            with col1:
-                st.button("Previous", on_click=previous_flashcard)
-            with col2:
-                st.button("Shuffle Cards", on_click=shuffle_flashcards)
-            with col3:
-                st.button("Next", on_click=next_flashcard)
+            with tab3:
+                # Detailed view with compounds, one expander per unique character, a page at a time
+                chars = [char for char in char_counts if char in chars_dict]
+                pages = max(1, (len(chars) + DETAILS_PAGE_SIZE - 1) // DETAILS_PAGE_SIZE)
+                page = 1
+                if pages > 1:
+                    page = st.number_input("Page", min_value=1, max_value=pages, value=1, key="details_page")
+                    st.caption(f"Page {page} of {pages}")
+                for char in chars[(page - 1) * DETAILS_PAGE_SIZE:page * DETAILS_PAGE_SIZE]:
+                    info = chars_dict[char]
+                    with st.expander(f"{char} ({info['pinyin']}) ×{char_counts[char]}"):
+                        st.write("**Meaning:**", info["meaning"])
+                        
+                        if info["compounds"]:
+                            st.write("**Compound Words:**")
+                            st.markdown('\n'.join(f"- {compound['word']}: {compound['meaning']}"
+                                                   for compound in info["compounds"]))
+                        render_all_compounds(char, f"details_{char}")
 
-            # Display current flashcard
-            current_char, current_info = st.session_state.flashcard_chars[st.session_state.current_char_index]
+    with main_tab2, metrics.timer('render.flashcards'):
+        # Add list selection dropdown
+        all_lists = ["All Characters"] + get_all_lists()
+        if st.session_state.selected_list not in all_lists:
+            st.session_state.selected_list = "All Characters"
+        selected_list = st.selectbox(
+            "Select Character List",
+            all_lists,
+            index=all_lists.index(st.session_state.selected_list)
+        )
+        
+        if selected_list != st.session_state.selected_list:
+            filter_flashcards_by_list(selected_list)
+        elif st.session_state.review_window is None:
+            refill_review_window()
+        
+        due_queue = get_due_queue()
+        window = st.session_state.review_window
+        # The window holds table IDs; IDs are stable as the table grows
+        current_char = get_char_table()[window[0]] if window else None
+        current_info = load_store().get(current_char) if current_char else None
+        
+        if not len(due_queue):
+            if st.session_state.selected_list == "All Characters":
+                st.error("No characters loaded. Please process some Chinese text first.")
+            else:
+                st.warning(f"No characters in the selected list: {st.session_state.selected_list}")
+        elif current_info is None:
+            st.success("No cards are due for review right now.")
+            next_due = due_queue.next_due_time()
+            if next_due is not None:
+                st.write(f"Next card is due {time.strftime('%Y-%m-%d %H:%M', time.localtime(next_due))}")
+            st.button("Study Ahead", on_click=refill_review_window, kwargs={"ahead": True})
+        else:
+            st.write(f"Practice with characters from: {selected_list}")
             
             # Create a card-like container
             card_container = st.container()
@@ -205,11 +388,15 @@ def main():
                 if st.session_state.selected_list != "All Characters":
                     if st.button("Remove from Current List"):
                         remove_from_list(st.session_state.selected_list, current_char)
-                        filter_flashcards_by_list(st.session_state.selected_list)
+                        refill_review_window()
                         st.success(f"Removed {current_char} from {st.session_state.selected_list}")
 
             # Toggle answer button
-            st.button("Show/Hide Answer", on_click=toggle_answer)
+            col1, col2 = st.columns(2)
+            with col1:
+                st.button("Show/Hide Answer", on_click=toggle_answer)
+            with col2:
+                st.button("Skip", on_click=skip_flashcard)
 
             # Show answer if toggled
             if st.session_state.show_answer:
@@ -236,31 +423,36 @@ def main():
                             unsafe_allow_html=True
                         )
                         
-                        # Create a grid layout for compounds
+                        # Create a grid layout for compounds, one markdown block per column
                         cols = st.columns(2)
-                        for idx, compound in enumerate(current_info["compounds"]):
-                            with cols[idx % 2]:
-                                st.markdown(
+                        for column, col in enumerate(cols):
+                            with col:
+                                st.markdown(''.join(
                                     f"""
                                     <div style='padding: 10px; border-radius: 5px; border: 1px solid #e0e0e0; margin: 5px 0;'>
                                         <h4 style='margin: 0; color: #1f77b4;'>{compound['word']}</h4>
                                         <p style='margin: 5px 0;'>{compound['meaning']}</p>
                                     </div>
-                                    """,
-                                    unsafe_allow_html=True
-                                )
+                                    """
+                                    for compound in current_info["compounds"][column::2]
+                                ), unsafe_allow_html=True)
+                    
+                    render_all_compounds(current_char, "flashcard")
+
+                    # Grade the recall; the scheduler decides when the card comes back
+                    st.write("How well did you remember it?")
+                    grade_cols = st.columns(len(GRADES))
+                    for col, (label, grade) in zip(grade_cols, GRADES.items()):
+                        with col:
+                            st.button(label, on_click=grade_flashcard, args=(grade,), key=f"grade_{label}")
 
             # Show progress
-            total_cards = len(st.session_state.flashcard_chars)
-            st.progress((st.session_state.current_char_index + 1) / total_cards)
-            st.write(f"Card {st.session_state.current_char_index + 1} of {total_cards}")
-        else:
-            if st.session_state.selected_list == "All Characters":
-                st.error("No characters loaded. Please check the characters JSON file.")
-            else:
-                st.warning(f"No characters in the selected list: {st.session_state.selected_list}")
+            state = get_scheduler().state(current_char)
+            status = "New card" if not state.last_review else f"Interval {state.interval_days:.1f} days, ease {state.ease:.2f}"
+            st.write(f"{status} · reviewed {st.session_state.reviewed_count} this session · "
+                     f"{len(window)} due in window · {len(due_queue)} cards in deck")
     
-    with main_tab3:
+    with main_tab3, metrics.timer('render.lists'):
         st.subheader("Manage Character Lists")
         
         # Create new list
@@ -275,13 +467,13 @@ def main():
         # Display existing lists
         st.subheader("Existing Lists")
         for list_name in get_all_lists():
-            with st.expander(f"{list_name} ({len(get_characters_in_list(list_name))} characters)"):
-                chars = get_characters_in_list(list_name)
+            chars = sorted(get_characters_in_list(list_name))
+            with st.expander(f"{list_name} ({len(chars)} characters)"):
                 if chars:
                     # Display characters in a grid with remove buttons
                     for i in range(0, len(chars), 4):  # Show 4 characters per row
                         cols = st.columns(4)
-                        for j, char in enumerate(sorted(chars)[i:i+4]):
+                        for j, char in enumerate(chars[i:i+4]):
                             with cols[j]:
                                 # Create a container for each character
                                 st.markdown(
@@ -307,5 +499,28 @@ def main():
                 else:
                     st.info("No characters in this list yet.")
 
+    with main_tab4, metrics.timer('render.search'):
+        st.subheader("Search the Dictionary")
+        query = st.text_input("English meaning or pinyin (e.g. \"to remember\", \"ji4 de5\", \"jide\"):",
+                              key="search_query")
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            mode = st.radio("Search by", list(SEARCH_MODES), horizontal=True, key="search_mode")
+        with col2:
+            prefix = st.checkbox("Match word beginnings", value=True, key="search_prefix")
+        if query.strip():
+            started = time.perf_counter()
+            results = search_dictionary(query, SEARCH_LIMIT, SEARCH_MODES[mode], prefix)
+            elapsed = (time.perf_counter() - started) * 1000
+            st.caption(f"{len(results)} results in {elapsed:.1f} ms")
+            if results:
+                st.dataframe([{"Word": result['word'], "Traditional": result['traditional'],
+                               "Pinyin": result['pinyin'], "Meaning": result['meaning']}
+                              for result in results])
+            else:
+                st.info("No dictionary entries match this search.")
+
+    render_diagnostics()
+
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,256 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional
+
+DEFAULT_TEXT_SIZES = [100, 10_000, 1_000_000]
+DEFAULT_DICT_SIZES = [10_000, 120_000]
+DEFAULT_REPEATS = 3
+REGRESSION_THRESHOLD = 0.2  # 20% slower than the baseline counts as a regression
+
+# Synthetic headwords draw on the most common part of the CJK block
+_CHAR_POOL = [chr(code) for code in range(0x4E00, 0x4E00 + 6000)]
+_INITIALS = ['b', 'p', 'm', 'f', 'd', 't', 'n', 'l', 'g', 'k', 'h', 'j', 'q', 'x', 'zh', 'ch', 'sh', 'r', 'z', 'c', 's', '']
+_FINALS = ['a', 'o', 'e', 'ai', 'ei', 'ao', 'ou', 'an', 'en', 'ang', 'eng', 'ong', 'i', 'u', 'ia', 'ie', 'iu', 'ui', 'un']
+_PUNCTUATION = '，。！？、；：'
+
+
+def _syllable(rng: random.Random) -> str:
+    return f'{rng.choice(_INITIALS)}{rng.choice(_FINALS)}{rng.randint(1, 5)}'
+
+
+def generate_cedict(path: str, size: int, seed: int = 0) -> List[str]:
+    """Write a synthetic CEDICT file with size entries, returns its multi-character headwords"""
+    rng = random.Random(seed)
+    words = set()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('# Synthetic CC-CEDICT for benchmarking\n')
+        singles = _CHAR_POOL[:min(size // 4, len(_CHAR_POOL))]
+        for char in singles:
+            f.write(f'{char} {char} [{_syllable(rng)}] /meaning of {char}/variant/\n')
+        while len(words) < size - len(singles):
+            word = ''.join(rng.choice(singles or _CHAR_POOL) for _ in range(rng.choice((2, 2, 2, 3, 4))))
+            if word in words:
+                continue
+            words.add(word)
+            reading = ' '.join(_syllable(rng) for _ in word)
+            f.write(f'{word} {word} [{reading}] /word {len(words)}/\n')
+    return sorted(words)
+
+
+def generate_corpus(size: int, words: List[str], seed: int = 0) -> str:
+    """Build a text of about size characters mixing dictionary words, single characters and punctuation"""
+    rng = random.Random(seed)
+    parts = []
+    length = 0
+    while length < size:
+        roll = rng.random()
+        if roll < 0.4 and words:
+            part = rng.choice(words)
+        elif roll < 0.9:
+            part = rng.choice(_CHAR_POOL[:3000])
+        elif roll < 0.98:
+            part = rng.choice(_PUNCTUATION)
+        else:
+            part = '\n'
+        parts.append(part)
+        length += len(part)
+    return ''.join(parts)[:size]
+
+
+@contextmanager
+def _working_directory(path: str) -> Iterator[None]:
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def measure(func: Callable[[], object], repeats: int, memory: bool,
+            setup: Optional[Callable[[], object]] = None) -> Dict[str, float]:
+    """Best-of-N wall time plus peak Python allocation of one extra run under tracemalloc
+
+    setup, if given, runs untimed before every run, e.g. to clear caches.
+    """
+    timings = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    result = {'seconds': min(timings), 'mean_seconds': sum(timings) / len(timings)}
+    if memory:
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            func()
+            result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(text_sizes: List[int], dict_sizes: List[int], repeats: int = DEFAULT_REPEATS,
+                   memory: bool = True, seed: int = 0, log=sys.stderr) -> Dict:
+    """Time every pipeline stage for each dictionary size and text size in a scratch directory"""
+    import cedict_index
+    import char_store
+    import character_lists
+    import processor
+    from compound_matcher import CompoundMatcher, get_matcher
+    import pinyin_engine
+    from pinyin_engine import full_pinyin
+    from segmenter import get_segmenter
+
+    results = []
+
+    def record(stage: str, dict_size: int, text_size: Optional[int], func: Callable[[], object],
+               stage_repeats: int = repeats, setup: Optional[Callable[[], object]] = None) -> None:
+        log.write(f"{stage:<28} dict={dict_size:<8} text={text_size or '-':<10}")
+        log.flush()
+        entry = {'stage': stage, 'dict_size': dict_size, 'text_size': text_size, 'repeats': stage_repeats}
+        entry.update(measure(func, stage_repeats, memory, setup))
+        log.write(f" {entry['seconds'] * 1000:10.2f} ms\n")
+        results.append(entry)
+
+    for dict_size in dict_sizes:
+        with tempfile.TemporaryDirectory() as workdir, _working_directory(workdir):
+            words = generate_cedict(cedict_index.CEDICT_FILE, dict_size, seed)
+            record('index_build', dict_size, None, cedict_index.build_index, 1)
+            index = cedict_index.get_index()
+            record('matcher_build', dict_size, None, lambda: CompoundMatcher(index.keys()), 1)
+            get_matcher(index)
+            # One-time table and segmenter builds are not part of any per-text stage
+            pinyin_engine.reading_table()
+            get_segmenter()
+
+            def clear_pinyin_caches() -> None:
+                # Otherwise every repeat after the first only measures cache hits
+                pinyin_engine._segment_readings.cache_clear()
+                pinyin_engine._word_readings.cache_clear()
+
+            def reset_store() -> None:
+                # Every run starts from an empty store, whichever backend is configured
+                char_store.close_store()
+                for name in os.listdir('.'):
+                    if name.startswith(char_store.CHARS_DB) or name in (
+                            char_store.CHARS_JSON, char_store.WORDS_JSON,
+                            char_store.SEGMENTS_JSON, char_store.REVIEWS_JSON,
+                            char_store.COMPOUND_COUNTS_JSON, char_store.HEADWORDS_JSON):
+                        os.remove(name)
+                clear_pinyin_caches()
+
+            sample_chars = _CHAR_POOL[:200]
+            record('get_meaning_from_cedict', dict_size, len(sample_chars),
+                   lambda: [processor.get_meaning_from_cedict(char, words[:5]) for char in sample_chars])
+
+            for text_size in text_sizes:
+                text = generate_corpus(text_size, words, seed)
+                record('find_compound_words', dict_size, text_size,
+                       lambda: processor.find_compound_words(text))
+                record('segment_text', dict_size, text_size, lambda: processor.segment_text(text))
+                record('full_pinyin', dict_size, text_size, lambda: full_pinyin(text),
+                       setup=clear_pinyin_caches)
+                record('process_chinese_text', dict_size, text_size,
+                       lambda: processor.process_chinese_text(text), setup=reset_store)
+                char_store.close_store()
+
+            list_chars = _CHAR_POOL[:1000]
+            record('lists_add_each', dict_size, len(list_chars),
+                   lambda: [character_lists.add_to_list('Bench', char) for char in list_chars], 1)
+            record('lists_add_many', dict_size, len(list_chars),
+                   lambda: character_lists.add_many_to_list('Bench2', list_chars))
+            record('lists_read', dict_size, len(list_chars),
+                   lambda: [character_lists.get_characters_in_list('Bench') for _ in range(1000)])
+
+    return {
+        'meta': {
+            'commit': _git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seed': seed,
+            'repeats': repeats,
+        },
+        'results': results,
+    }
+
+
+def compare_results(current: Dict, baseline: Dict, threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    """Describe every stage that got slower than baseline by more than threshold"""
+    def key(entry: Dict) -> tuple:
+        return entry['stage'], entry['dict_size'], entry['text_size']
+
+    previous = {key(entry): entry for entry in baseline['results']}
+    regressions = []
+    for entry in current['results']:
+        old = previous.get(key(entry))
+        if old is None or old['seconds'] <= 0:
+            continue
+        ratio = entry['seconds'] / old['seconds']
+        if ratio > 1 + threshold:
+            regressions.append(
+                f"{entry['stage']} (dict={entry['dict_size']}, text={entry['text_size']}): "
+                f"{old['seconds'] * 1000:.2f} ms -> {entry['seconds'] * 1000:.2f} ms ({ratio:.2f}x)")
+    return regressions
+
+
+def _parse_sizes(value: str) -> List[int]:
+    return [int(size.replace('_', '')) for size in value.split(',') if size]
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark the processing pipeline on synthetic data")
+    parser.add_argument("--text-sizes", type=_parse_sizes, default=DEFAULT_TEXT_SIZES,
+                        help="comma-separated corpus sizes in characters, e.g. 100,10000,10000000")
+    parser.add_argument("--dict-sizes", type=_parse_sizes, default=DEFAULT_DICT_SIZES,
+                        help="comma-separated synthetic CEDICT sizes in entries")
+    parser.add_argument("--repeats", type=int, default=DEFAULT_REPEATS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc peak-memory run")
+    parser.add_argument("--output", default="bench_results.json", help="where to write the JSON results")
+    parser.add_argument("--compare", help="baseline results file to check for regressions")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    # Benchmarks run in a scratch directory, so the modules must be importable from here
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    results = run_benchmarks(args.text_sizes, args.dict_sizes, args.repeats,
+                             memory=not args.no_memory, seed=args.seed)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote {len(results['results'])} results to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.threshold)
+        for line in regressions:
+            print(f"Regression: {line}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions found")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+import array
+import hashlib
+import mmap
+import os
+import struct
+import threading
+from typing import Callable, Dict, Generic, Iterator, List, NamedTuple, Optional, Tuple, TypeVar
+
+from instrumentation import metrics
+
+CEDICT_FILE = 'cedict_ts.u8'
+INDEX_FILE = 'cedict_ts.idx'
+
+INDEX_MAGIC = b'CEDX'
+INDEX_VERSION = 1
+
+# magic, format version, sha256 of source, source size, source mtime_ns, key count, entry count
+_HEADER = struct.Struct('=4sI32sQqII')
+_UINT = 'I'
+
+
+class CedictEntry(NamedTuple):
+    traditional: str
+    simplified: str
+    pinyin: str
+    definitions: List[str]
+
+
+def parse_cedict_line(line: str) -> Optional[CedictEntry]:
+    """Parse a single CEDICT line into an entry, None for comments and malformed lines"""
+    if line.startswith('#'):
+        return None
+    parts = line.strip().split('/')
+    head = parts[0].split()
+    if len(head) < 2:
+        return None
+    start = parts[0].find('[')
+    end = parts[0].find(']', start + 1)
+    reading = parts[0][start + 1:end] if start != -1 and end != -1 else ''
+    return CedictEntry(head[0], head[1], reading, [m for m in parts[1:-1] if m])
+
+
+def hash_file(path: str) -> bytes:
+    """Return the sha256 digest of a file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.digest()
+
+
+def _scan_source(source: str) -> Tuple[List[bytes], List[List[int]]]:
+    """Collect every simplified headword with the byte offsets of its lines"""
+    headwords = {}
+    offset = 0
+    lines = 0
+    with open(source, 'rb') as f:
+        for line in f:
+            lines += 1
+            if not line.startswith(b'#'):
+                head = line.split(b'/', 1)[0].split()
+                if len(head) > 1:
+                    headwords.setdefault(head[1], []).append(offset)
+            offset += len(line)
+    metrics.incr('cedict.lines_scanned', lines)
+    keys = sorted(headwords)
+    return keys, [headwords[key] for key in keys]
+
+
+@metrics.timed('cedict.index_build')
+def build_index(source: str = CEDICT_FILE, index_path: str = INDEX_FILE) -> None:
+    """Compile the CEDICT source into a sorted, mmap-able headword index"""
+    digest = hash_file(source)
+    stat = os.stat(source)
+    keys, offsets = _scan_source(source)
+
+    key_offsets = array.array(_UINT, [0])
+    entry_starts = array.array(_UINT, [0])
+    line_offsets = array.array(_UINT)
+    for key, key_lines in zip(keys, offsets):
+        key_offsets.append(key_offsets[-1] + len(key))
+        line_offsets.extend(key_lines)
+        entry_starts.append(len(line_offsets))
+
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, digest, stat.st_size,
+                             stat.st_mtime_ns, len(keys), len(line_offsets)))
+        key_offsets.tofile(f)
+        entry_starts.tofile(f)
+        line_offsets.tofile(f)
+        f.write(b''.join(keys))
+        metrics.incr('cedict.index_bytes_written', f.tell())
+    os.replace(tmp_path, index_path)
+
+
+def read_header(index_path: str, header: struct.Struct, magic: bytes, version: int) -> Optional[tuple]:
+    """Unpack the header of a compiled index, None if it is missing or in another format
+
+    Every compiled index header starts with magic, format version, source sha256,
+    source size and source mtime_ns, so they share the rebuild rules below.
+    """
+    try:
+        with open(index_path, 'rb') as f:
+            data = f.read(header.size)
+    except OSError:
+        return None
+    if len(data) < header.size:
+        return None
+    fields = header.unpack(data)
+    if fields[0] != magic or fields[1] != version:
+        return None
+    return fields
+
+
+def ensure_compiled(source: str, index_path: str, header: struct.Struct, magic: bytes, version: int,
+                    build: Callable[[str, str], None]) -> None:
+    """Run build(source, index_path) if the index is missing or the source file's hash has changed"""
+    stat = os.stat(source)
+    fields = read_header(index_path, header, magic, version)
+    if fields is not None:
+        digest, size, mtime_ns = fields[2:5]
+        if size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+            return
+        if digest == hash_file(source):
+            # Same content with a new mtime: refresh the header instead of rebuilding
+            with open(index_path, 'r+b') as f:
+                f.write(header.pack(*fields[:3], stat.st_size, stat.st_mtime_ns, *fields[5:]))
+            return
+    build(source, index_path)
+
+
+def ensure_index(source: str = CEDICT_FILE, index_path: str = INDEX_FILE) -> None:
+    """Build the index if it is missing or the source file's hash has changed"""
+    ensure_compiled(source, index_path, _HEADER, INDEX_MAGIC, INDEX_VERSION, build_index)
+
+
+def map_file(path: str) -> mmap.mmap:
+    """Map a whole file read-only"""
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def lower_bound(key: bytes, count: int, key_at: Callable[[int], bytes]) -> int:
+    """First position in a sorted sequence of count byte keys whose key is not below key"""
+    lo, hi = 0, count
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key_at(mid) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class CedictIndex:
+    """Read-only view over a compiled CEDICT index and its source file"""
+
+    def __init__(self, source: str = CEDICT_FILE, index_path: str = INDEX_FILE):
+        self.source = source
+        self.index_path = index_path
+        self._index_map = map_file(index_path)
+        self._source_map = map_file(source)
+
+        _, _, digest, _, _, n_keys, n_entries = _HEADER.unpack_from(self._index_map, 0)
+        self.digest = digest
+        self._n_keys = n_keys
+        view = self._view = memoryview(self._index_map)
+        pos = _HEADER.size
+        width = array.array(_UINT).itemsize
+        self._key_offsets = view[pos:pos + (n_keys + 1) * width].cast(_UINT)
+        pos += (n_keys + 1) * width
+        self._entry_starts = view[pos:pos + (n_keys + 1) * width].cast(_UINT)
+        pos += (n_keys + 1) * width
+        self._line_offsets = view[pos:pos + n_entries * width].cast(_UINT)
+        pos += n_entries * width
+        self._keys_base = pos
+        self._max_key_length = None
+        self._containing: Optional[Dict[str, array.array]] = None
+        self._containing_lock = threading.Lock()
+
+    @property
+    def version(self) -> str:
+        """Short identifier of the dictionary content this index was built from"""
+        return self.digest.hex()[:16]
+
+    def __len__(self) -> int:
+        return self._n_keys
+
+    def __contains__(self, word: str) -> bool:
+        return self._find(word.encode('utf-8')) is not None
+
+    def _key(self, i: int) -> bytes:
+        base = self._keys_base
+        return self._index_map[base + self._key_offsets[i]:base + self._key_offsets[i + 1]]
+
+    def _lower_bound(self, key: bytes) -> int:
+        return lower_bound(key, self._n_keys, self._key)
+
+    def _find(self, key: bytes) -> Optional[int]:
+        i = self._lower_bound(key)
+        if i < self._n_keys and self._key(i) == key:
+            return i
+        return None
+
+    def _line(self, offset: int) -> str:
+        end = self._source_map.find(b'\n', offset)
+        if end == -1:
+            end = len(self._source_map)
+        return self._source_map[offset:end].decode('utf-8')
+
+    def lookup(self, word: str) -> List[CedictEntry]:
+        """Return every entry whose simplified headword is word, in file order"""
+        metrics.incr('cedict.lookups')
+        i = self._find(word.encode('utf-8'))
+        if i is None:
+            return []
+        metrics.incr('cedict.lines_read', self._entry_starts[i + 1] - self._entry_starts[i])
+        entries = []
+        for j in range(self._entry_starts[i], self._entry_starts[i + 1]):
+            entry = parse_cedict_line(self._line(self._line_offsets[j]))
+            if entry is not None:
+                entries.append(entry)
+        return entries
+
+    def has_prefix(self, prefix: str) -> bool:
+        """Check whether any headword starts with prefix"""
+        key = prefix.encode('utf-8')
+        i = self._lower_bound(key)
+        return i < self._n_keys and self._key(i).startswith(key)
+
+    def keys(self) -> Iterator[str]:
+        """Iterate over all simplified headwords in sorted order"""
+        for i in range(self._n_keys):
+            yield self._key(i).decode('utf-8')
+
+    @property
+    def max_key_length(self) -> int:
+        """Length in characters of the longest headword"""
+        if self._max_key_length is None:
+            self._max_key_length = max((len(key) for key in self.keys()), default=0)
+        return self._max_key_length
+
+    def words_containing(self, char: str) -> List[str]:
+        """Multi-character headwords that contain char, in sorted order"""
+        with self._containing_lock:
+            if self._containing is None:
+                # Built on first use only: a key number per headword, grouped by character
+                with metrics.timer('cedict.containing_build'):
+                    containing = {}
+                    for i, key in enumerate(self.keys()):
+                        if len(key) > 1:
+                            for member in set(key):
+                                containing.setdefault(member, array.array(_UINT)).append(i)
+                    self._containing = containing
+        return [self._key(i).decode('utf-8') for i in self._containing.get(char, ())]
+
+    def close(self) -> None:
+        self._key_offsets.release()
+        self._entry_starts.release()
+        self._line_offsets.release()
+        self._view.release()
+        self._index_map.close()
+        self._source_map.close()
+
+
+T = TypeVar('T')
+
+
+class IndexCache(Generic[T]):
+    """Process-wide instance of an index compiled from a source file, reopened when the file changes"""
+
+    def __init__(self, name: str, ensure: Callable[[str, str], None], open_index: Callable[[str, str], T]):
+        self.name = name
+        self._ensure = ensure
+        self._open = open_index
+        self._index: Optional[T] = None
+        self._stat = None
+        self._lock = threading.Lock()
+
+    def get(self, source: str, index_path: str) -> Optional[T]:
+        try:
+            stat = os.stat(source)
+        except FileNotFoundError:
+            return None
+        key = (os.path.abspath(source), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            if self._index is not None and self._stat == key:
+                metrics.incr(f'{self.name}.index_cache_hits')
+            else:
+                metrics.incr(f'{self.name}.index_cache_misses')
+                # Sessions may still hold the old index, so it is left to the garbage collector
+                self._ensure(source, index_path)
+                self._index = self._open(source, index_path)
+                self._stat = key
+            return self._index
+
+
+_index_cache = IndexCache('cedict', ensure_index, CedictIndex)
+
+
+def get_index(source: str = CEDICT_FILE, index_path: str = INDEX_FILE) -> Optional[CedictIndex]:
+    """Return the process-wide index, rebuilding it when the source file changes"""
+    return _index_cache.get(source, index_path)
@@ -0,0 +1,667 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from typing import Callable, Dict, Hashable, Iterable, Iterator, List, Mapping, Optional, Set, Tuple
+
+from file_utils import atomic_open, file_signature
+from instrumentation import metrics
+
+CHARS_JSON = 'chars.json'
+CHARS_DB = 'chars.db'
+WORDS_JSON = 'words.json'
+SEGMENTS_JSON = 'segments.json'
+REVIEWS_JSON = 'reviews.json'
+COMPOUND_COUNTS_JSON = 'compound_counts.json'
+HEADWORDS_JSON = 'headwords.json'
+DEFAULT_BACKEND = 'sqlite'
+BACKEND_ENV = 'CHARS_STORE'
+
+# SQLite caps the number of bound parameters per statement
+_BATCH_SIZE = 500
+
+
+def read_json_chars(path: str = CHARS_JSON) -> Dict:
+    """Load a whole chars.json file, empty if it does not exist"""
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {}
+
+
+def write_json_chars(items: Iterable[Tuple[str, Dict]], path: str = CHARS_JSON) -> None:
+    """Write entries in the chars.json layout one at a time, without building the whole dict"""
+    with atomic_open(path) as f:
+        f.write('{')
+        first = True
+        for char, info in items:
+            body = json.dumps(info, ensure_ascii=False, indent=2).replace('\n', '\n  ')
+            f.write(('\n' if first else ',\n') + f'  {json.dumps(char, ensure_ascii=False)}: {body}')
+            first = False
+        f.write('}' if first else '\n}')
+        metrics.incr('store.bytes_written', f.tell())
+
+
+class CharStore:
+    """Interface shared by the character storage backends"""
+
+    def get(self, char: str) -> Optional[Dict]:
+        return self.get_many([char]).get(char)
+
+    def get_many(self, chars: Iterable[str]) -> Dict[str, Dict]:
+        """Return the stored entries for whichever of chars are present"""
+        raise NotImplementedError
+
+    def missing(self, chars: Iterable[str]) -> Set[str]:
+        """Return the characters that have no entry yet"""
+        chars = set(chars)
+        return chars - set(self.get_many(chars))
+
+    def add_new(self, entries: Dict[str, Dict]) -> int:
+        """Insert entries for characters not already stored, returns how many were added"""
+        raise NotImplementedError
+
+    def upsert(self, entries: Dict[str, Dict]) -> None:
+        """Insert or replace entries"""
+        raise NotImplementedError
+
+    def items(self) -> Iterator[Tuple[str, Dict]]:
+        """Iterate over all entries in insertion order"""
+        raise NotImplementedError
+
+    def keys(self) -> Iterator[str]:
+        """Iterate over all stored characters in insertion order"""
+        return (char for char, _ in self.items())
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def get_words(self, words: Iterable[str]) -> Dict[str, Dict]:
+        """Return the stored word-level entries for whichever of words are present"""
+        raise NotImplementedError
+
+    def missing_words(self, words: Iterable[str]) -> Set[str]:
+        """Return the words that have no entry yet"""
+        words = set(words)
+        return words - set(self.get_words(words))
+
+    def add_new_words(self, entries: Dict[str, Dict]) -> int:
+        """Insert word entries not already stored, returns how many were added"""
+        raise NotImplementedError
+
+    def upsert_words(self, entries: Dict[str, Dict]) -> None:
+        """Insert or replace word entries"""
+        raise NotImplementedError
+
+    def iter_words(self) -> Iterator[Tuple[str, Dict]]:
+        """Iterate over all word entries in insertion order"""
+        raise NotImplementedError
+
+    def stale_chars(self, dict_version: str) -> List[str]:
+        """Characters whose entries were built from a different dictionary version"""
+        return [char for char, info in self.items() if info.get('dict_version') != dict_version]
+
+    def stale_words(self, dict_version: str) -> List[str]:
+        """Words whose entries were built from a different dictionary version"""
+        return [word for word, info in self.iter_words() if info.get('dict_version') != dict_version]
+
+    def seen_segments(self, fingerprints: Iterable[str]) -> Dict[str, int]:
+        """Map the text segment fingerprints analyzed before to the dictionary generation they were analyzed at"""
+        raise NotImplementedError
+
+    def dictionary_generation(self, version: str, headwords: Callable[[], Iterable[str]]) -> int:
+        """Number dictionary versions in the order they are first seen, from 1
+
+        The first time a version is seen, its headwords not known yet are recorded
+        as introduced by it.
+        """
+        raise NotImplementedError
+
+    def headword_generations(self, words: Iterable[str]) -> Dict[str, int]:
+        """Return the dictionary generation that introduced each of words, for those recorded"""
+        raise NotImplementedError
+
+    def get_compound_counts(self, chars: Iterable[str]) -> Dict[str, Dict[str, int]]:
+        """Map each of chars to every compound containing it seen in analyzed text, with its count"""
+        raise NotImplementedError
+
+    def add_compound_counts(self, counts: Mapping[str, int]) -> None:
+        """Add occurrences of compounds found in newly analyzed text to their running counts"""
+        raise NotImplementedError
+
+    def merge_compound_counts(self, counts: Mapping[str, int]) -> None:
+        """Raise stored counts to at least the given ones, so loading the same counts twice changes nothing"""
+        raise NotImplementedError
+
+    def claim_segments(self, segments: Mapping[str, Optional[int]], generation: int,
+                       count: Callable[[Set[str]], Mapping[str, int]]) -> Set[str]:
+        """Mark segments as analyzed at generation and add their compound counts in one transaction
+
+        segments maps each fingerprint to the generation it was seen at, None if unseen.
+        Only fingerprints still in that state are claimed, so concurrent writers never
+        count a segment twice; count is called with the claimed ones and returns the
+        compound counts to add. Returns the claimed fingerprints.
+        """
+        raise NotImplementedError
+
+    def get_reviews(self, chars: Iterable[str]) -> Dict[str, Dict]:
+        """Return the flashcard review state of whichever of chars were reviewed"""
+        raise NotImplementedError
+
+    def save_reviews(self, entries: Dict[str, Dict]) -> None:
+        """Insert or replace review states in one write"""
+        raise NotImplementedError
+
+    def iter_reviews(self) -> Iterator[Tuple[str, Dict]]:
+        """Iterate over every stored review state"""
+        raise NotImplementedError
+
+    def __contains__(self, char: str) -> bool:
+        return self.get(char) is not None
+
+    def version(self) -> Hashable:
+        """Token that changes whenever the character or word data changes"""
+        raise NotImplementedError
+
+    def export_json(self, path: str = CHARS_JSON) -> None:
+        """Write the store out in the chars.json format"""
+        write_json_chars(self.items(), path)
+
+    def close(self) -> None:
+        pass
+
+
+class JsonCharStore(CharStore):
+    """Store backed by a single chars.json file, rewritten on every change"""
+
+    def __init__(self, path: str = CHARS_JSON, words_path: str = WORDS_JSON,
+                 segments_path: str = SEGMENTS_JSON, reviews_path: str = REVIEWS_JSON,
+                 counts_path: str = COMPOUND_COUNTS_JSON, headwords_path: str = HEADWORDS_JSON):
+        self.path = path
+        self.words_path = words_path
+        self.segments_path = segments_path
+        self.reviews_path = reviews_path
+        self.counts_path = counts_path
+        self.headwords_path = headwords_path
+        self._lock = threading.Lock()
+
+    def get_many(self, chars: Iterable[str]) -> Dict[str, Dict]:
+        chars_dict = read_json_chars(self.path)
+        return {char: chars_dict[char] for char in chars if char in chars_dict}
+
+    def add_new(self, entries: Dict[str, Dict]) -> int:
+        with self._lock:
+            chars_dict = read_json_chars(self.path)
+            new = {char: info for char, info in entries.items() if char not in chars_dict}
+            if new:
+                chars_dict.update(new)
+                write_json_chars(chars_dict.items(), self.path)
+            return len(new)
+
+    def upsert(self, entries: Dict[str, Dict]) -> None:
+        with self._lock:
+            chars_dict = read_json_chars(self.path)
+            chars_dict.update(entries)
+            write_json_chars(chars_dict.items(), self.path)
+
+    def items(self) -> Iterator[Tuple[str, Dict]]:
+        return iter(read_json_chars(self.path).items())
+
+    def __len__(self) -> int:
+        return len(read_json_chars(self.path))
+
+    def get_words(self, words: Iterable[str]) -> Dict[str, Dict]:
+        words_dict = read_json_chars(self.words_path)
+        return {word: words_dict[word] for word in words if word in words_dict}
+
+    def add_new_words(self, entries: Dict[str, Dict]) -> int:
+        with self._lock:
+            words_dict = read_json_chars(self.words_path)
+            new = {word: info for word, info in entries.items() if word not in words_dict}
+            if new:
+                words_dict.update(new)
+                write_json_chars(words_dict.items(), self.words_path)
+            return len(new)
+
+    def upsert_words(self, entries: Dict[str, Dict]) -> None:
+        with self._lock:
+            words_dict = read_json_chars(self.words_path)
+            words_dict.update(entries)
+            write_json_chars(words_dict.items(), self.words_path)
+
+    def iter_words(self) -> Iterator[Tuple[str, Dict]]:
+        return iter(read_json_chars(self.words_path).items())
+
+    def _read_segments(self) -> Dict[str, int]:
+        if os.path.exists(self.segments_path) and os.path.getsize(self.segments_path) > 0:
+            with open(self.segments_path, 'r', encoding='utf-8') as f:
+                segments = json.load(f)
+            # Older files list the fingerprints only
+            return dict.fromkeys(segments, 1) if isinstance(segments, list) else segments
+        return {}
+
+    def seen_segments(self, fingerprints: Iterable[str]) -> Dict[str, int]:
+        segments = self._read_segments()
+        return {fingerprint: segments[fingerprint] for fingerprint in fingerprints if fingerprint in segments}
+
+    def _read_headwords(self) -> Dict:
+        headwords = read_json_chars(self.headwords_path)
+        return {'versions': headwords.get('versions', []), 'words': headwords.get('words', {})}
+
+    def dictionary_generation(self, version: str, headwords: Callable[[], Iterable[str]]) -> int:
+        with self._lock:
+            known = self._read_headwords()
+            if version in known['versions']:
+                return known['versions'].index(version) + 1
+            known['versions'].append(version)
+            generation = len(known['versions'])
+            for word in headwords():
+                known['words'].setdefault(word, generation)
+            with atomic_open(self.headwords_path) as f:
+                json.dump(known, f, ensure_ascii=False)
+            return generation
+
+    def headword_generations(self, words: Iterable[str]) -> Dict[str, int]:
+        known = self._read_headwords()['words']
+        return {word: known[word] for word in words if word in known}
+
+    def get_compound_counts(self, chars: Iterable[str]) -> Dict[str, Dict[str, int]]:
+        chars = set(chars)
+        found = {}
+        for word, count in read_json_chars(self.counts_path).items():
+            for char in chars.intersection(word):
+                found.setdefault(char, {})[word] = count
+        return found
+
+    def _write_compound_counts(self, counts: Mapping[str, int]) -> None:
+        stored = read_json_chars(self.counts_path)
+        for word, count in counts.items():
+            stored[word] = stored.get(word, 0) + count
+        with atomic_open(self.counts_path) as f:
+            json.dump(stored, f, ensure_ascii=False)
+
+    def add_compound_counts(self, counts: Mapping[str, int]) -> None:
+        with self._lock:
+            self._write_compound_counts(counts)
+
+    def merge_compound_counts(self, counts: Mapping[str, int]) -> None:
+        with self._lock:
+            stored = read_json_chars(self.counts_path)
+            for word, count in counts.items():
+                stored[word] = max(stored.get(word, 0), count)
+            with atomic_open(self.counts_path) as f:
+                json.dump(stored, f, ensure_ascii=False)
+
+    def claim_segments(self, segments: Mapping[str, Optional[int]], generation: int,
+                       count: Callable[[Set[str]], Mapping[str, int]]) -> Set[str]:
+        with self._lock:
+            stored = self._read_segments()
+            claimed = {fingerprint for fingerprint, previous in segments.items()
+                       if stored.get(fingerprint) == previous}
+            counts = count(claimed)
+            if counts:
+                self._write_compound_counts(counts)
+            if claimed:
+                stored.update(dict.fromkeys(claimed, generation))
+                with atomic_open(self.segments_path) as f:
+                    json.dump(stored, f)
+            return claimed
+
+    def get_reviews(self, chars: Iterable[str]) -> Dict[str, Dict]:
+        reviews = read_json_chars(self.reviews_path)
+        return {char: reviews[char] for char in chars if char in reviews}
+
+    def save_reviews(self, entries: Dict[str, Dict]) -> None:
+        with self._lock:
+            reviews = read_json_chars(self.reviews_path)
+            reviews.update(entries)
+            with atomic_open(self.reviews_path) as f:
+                json.dump(reviews, f, ensure_ascii=False)
+
+    def iter_reviews(self) -> Iterator[Tuple[str, Dict]]:
+        return iter(read_json_chars(self.reviews_path).items())
+
+    def version(self) -> Hashable:
+        return file_signature(self.path), file_signature(self.words_path)
+
+
+class SqliteCharStore(CharStore):
+    """Store backed by an SQLite database in WAL mode with per-character rows"""
+
+    CHAR_COLUMNS = ('pinyin', 'meaning', 'compounds', 'dict_version')
+    WORD_COLUMNS = ('pinyin', 'meaning', 'dict_version')
+    REVIEW_COLUMNS = ('due', 'interval_days', 'ease', 'reps', 'lapses', 'last_review')
+    # Columns holding JSON-encoded values
+    JSON_COLUMNS = {'compounds'}
+
+    # Each step upgrades the schema by one version, recorded in PRAGMA user_version
+    SCHEMA_STEPS = (
+        (
+            'CREATE TABLE IF NOT EXISTS chars ('
+            ' char TEXT PRIMARY KEY, pinyin TEXT NOT NULL, meaning TEXT NOT NULL,'
+            ' compounds TEXT NOT NULL)',
+            'CREATE TABLE IF NOT EXISTS words ('
+            ' word TEXT PRIMARY KEY, pinyin TEXT NOT NULL, meaning TEXT NOT NULL)',
+        ),
+        (
+            "ALTER TABLE chars ADD COLUMN dict_version TEXT NOT NULL DEFAULT ''",
+            "ALTER TABLE words ADD COLUMN dict_version TEXT NOT NULL DEFAULT ''",
+            'CREATE TABLE segments (fingerprint TEXT PRIMARY KEY) WITHOUT ROWID',
+        ),
+        (
+            'CREATE TABLE reviews ('
+            ' char TEXT PRIMARY KEY, due REAL NOT NULL, interval_days REAL NOT NULL,'
+            ' ease REAL NOT NULL, reps INTEGER NOT NULL, lapses INTEGER NOT NULL,'
+            ' last_review REAL NOT NULL)',
+        ),
+        (
+            # One row per character of each counted word, so a character's compounds are a range scan
+            'CREATE TABLE compound_counts ('
+            ' char TEXT NOT NULL, word TEXT NOT NULL, count INTEGER NOT NULL,'
+            ' PRIMARY KEY (char, word)) WITHOUT ROWID',
+            # Seeded from the counts kept inside the stored compound
+            # entries, with 0 for compounds stored before counts were kept
+            "INSERT OR IGNORE INTO compound_counts (char, word, count)"
+            " SELECT chars.char, json_extract(value, '$.word'), COALESCE(json_extract(value, '$.count'), 0)"
+            " FROM chars, json_each(chars.compounds)",
+            # Fingerprints used to include the dictionary version and can no longer match
+            'DELETE FROM segments',
+        ),
+        (
+            # Paragraphs analyzed so far count as analyzed at the first dictionary seen from now on
+            'ALTER TABLE segments ADD COLUMN generation INTEGER NOT NULL DEFAULT 1',
+            'CREATE TABLE dictionaries (generation INTEGER PRIMARY KEY, version TEXT NOT NULL UNIQUE)',
+            'CREATE TABLE headwords (word TEXT PRIMARY KEY, generation INTEGER NOT NULL) WITHOUT ROWID',
+        ),
+    )
+
+    def __init__(self, path: str = CHARS_DB):
+        self.path = path
+        self._lock = threading.RLock()
+        # Streamlit serves sessions from several threads, so access is serialized by the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._migrate_schema()
+        self._writes = 0
+
+    def _migrate_schema(self) -> None:
+        with self._conn:
+            current = self._conn.execute('PRAGMA user_version').fetchone()[0]
+            for version, statements in enumerate(self.SCHEMA_STEPS[current:], start=current + 1):
+                for statement in statements:
+                    self._conn.execute(statement)
+                self._conn.execute(f'PRAGMA user_version = {version}')
+
+    def _to_row(self, key: str, info: Dict, columns: Tuple[str, ...]) -> Tuple[str, ...]:
+        row = (key,) + tuple(
+            json.dumps(info.get(column, []), ensure_ascii=False) if column in self.JSON_COLUMNS
+            else info.get(column, '')
+            for column in columns)
+        metrics.incr('store.bytes_written', sum(
+            len(value.encode('utf-8')) if isinstance(value, str) else 8 for value in row))
+        return row
+
+    def _from_row(self, row: Tuple[str, ...], columns: Tuple[str, ...]) -> Tuple[str, Dict]:
+        return row[0], {
+            column: json.loads(value) if column in self.JSON_COLUMNS else value
+            for column, value in zip(columns, row[1:])
+        }
+
+    def _select(self, table: str, key: str, columns: Tuple[str, ...], keys: Iterable[str]) -> Dict[str, Dict]:
+        keys = list(set(keys))
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), _BATCH_SIZE):
+                batch = keys[i:i + _BATCH_SIZE]
+                rows = self._conn.execute(
+                    'SELECT %s FROM %s WHERE %s IN (%s)'
+                    % (', '.join((key,) + columns), table, key, ','.join('?' * len(batch))), batch)
+                found.update(self._from_row(row, columns) for row in rows)
+        metrics.incr('store.rows_read', len(found))
+        return found
+
+    def _insert(self, table: str, key: str, columns: Tuple[str, ...], entries: Dict[str, Dict],
+                replace: bool, bump_version: bool = True) -> int:
+        placeholders = ', '.join('?' * (len(columns) + 1))
+        if replace:
+            statement = 'INSERT INTO %s (%s, %s) VALUES (%s) ON CONFLICT(%s) DO UPDATE SET %s' % (
+                table, key, ', '.join(columns), placeholders, key,
+                ', '.join(f'{column} = excluded.{column}' for column in columns))
+        else:
+            statement = 'INSERT OR IGNORE INTO %s (%s, %s) VALUES (%s)' % (
+                table, key, ', '.join(columns), placeholders)
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany(
+                statement, (self._to_row(k, info, columns) for k, info in entries.items()))
+            changed = self._conn.total_changes - before
+            metrics.incr('store.rows_written', changed)
+            if changed and bump_version:
+                self._writes += 1
+            return changed
+
+    def _iter_table(self, table: str, key: str, columns: Tuple[str, ...]) -> Iterator[Tuple[str, Dict]]:
+        # Read in pages so the whole table is never held in memory at once
+        last_rowid = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    'SELECT %s FROM %s WHERE rowid > ? ORDER BY rowid LIMIT ?'
+                    % (', '.join(('rowid', key) + columns), table), (last_rowid, _BATCH_SIZE)).fetchall()
+            if not rows:
+                return
+            for row in rows:
+                yield self._from_row(row[1:], columns)
+            last_rowid = rows[-1][0]
+
+    def get_many(self, chars: Iterable[str]) -> Dict[str, Dict]:
+        return self._select('chars', 'char', self.CHAR_COLUMNS, chars)
+
+    def missing(self, chars: Iterable[str]) -> Set[str]:
+        chars = set(chars)
+        return chars - set(self._select('chars', 'char', (), chars))
+
+    def add_new(self, entries: Dict[str, Dict]) -> int:
+        return self._insert('chars', 'char', self.CHAR_COLUMNS, entries, replace=False)
+
+    def upsert(self, entries: Dict[str, Dict]) -> None:
+        self._insert('chars', 'char', self.CHAR_COLUMNS, entries, replace=True)
+
+    def items(self) -> Iterator[Tuple[str, Dict]]:
+        return self._iter_table('chars', 'char', self.CHAR_COLUMNS)
+
+    def keys(self) -> Iterator[str]:
+        return (char for char, _ in self._iter_table('chars', 'char', ()))
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM chars').fetchone()[0]
+
+    def get_words(self, words: Iterable[str]) -> Dict[str, Dict]:
+        return self._select('words', 'word', self.WORD_COLUMNS, words)
+
+    def add_new_words(self, entries: Dict[str, Dict]) -> int:
+        return self._insert('words', 'word', self.WORD_COLUMNS, entries, replace=False)
+
+    def upsert_words(self, entries: Dict[str, Dict]) -> None:
+        self._insert('words', 'word', self.WORD_COLUMNS, entries, replace=True)
+
+    def iter_words(self) -> Iterator[Tuple[str, Dict]]:
+        return self._iter_table('words', 'word', self.WORD_COLUMNS)
+
+    def stale_chars(self, dict_version: str) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                'SELECT char FROM chars WHERE dict_version != ? ORDER BY rowid', (dict_version,))]
+
+    def stale_words(self, dict_version: str) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                'SELECT word FROM words WHERE dict_version != ? ORDER BY rowid', (dict_version,))]
+
+    def seen_segments(self, fingerprints: Iterable[str]) -> Dict[str, int]:
+        rows = self._select('segments', 'fingerprint', ('generation',), fingerprints)
+        return {fingerprint: row['generation'] for fingerprint, row in rows.items()}
+
+    def dictionary_generation(self, version: str, headwords: Callable[[], Iterable[str]]) -> int:
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT generation FROM dictionaries WHERE version = ?', (version,)).fetchone()
+            if row is not None:
+                return row[0]
+            generation = self._conn.execute('INSERT INTO dictionaries (version) VALUES (?)', (version,)).lastrowid
+            self._conn.executemany('INSERT OR IGNORE INTO headwords (word, generation) VALUES (?, ?)',
+                                   ((word, generation) for word in headwords()))
+            return generation
+
+    def headword_generations(self, words: Iterable[str]) -> Dict[str, int]:
+        rows = self._select('headwords', 'word', ('generation',), words)
+        return {word: row['generation'] for word, row in rows.items()}
+
+    def get_compound_counts(self, chars: Iterable[str]) -> Dict[str, Dict[str, int]]:
+        chars = list(set(chars))
+        found = {}
+        rows_read = 0
+        with self._lock:
+            for i in range(0, len(chars), _BATCH_SIZE):
+                batch = chars[i:i + _BATCH_SIZE]
+                rows = self._conn.execute(
+                    'SELECT char, word, count FROM compound_counts WHERE char IN (%s)'
+                    % ','.join('?' * len(batch)), batch)
+                for char, word, count in rows:
+                    found.setdefault(char, {})[word] = count
+                    rows_read += 1
+        metrics.incr('store.rows_read', rows_read)
+        return found
+
+    def _write_compound_counts(self, counts: Mapping[str, int]) -> None:
+        rows = [(char, word, count) for word, count in counts.items() for char in set(word)]
+        # Counts only change the ranking of compounds, so cached snapshots stay valid
+        self._conn.executemany(
+            'INSERT INTO compound_counts (char, word, count) VALUES (?, ?, ?)'
+            ' ON CONFLICT(char, word) DO UPDATE SET count = count + excluded.count', rows)
+        metrics.incr('store.rows_written', len(rows))
+
+    def add_compound_counts(self, counts: Mapping[str, int]) -> None:
+        with self._lock, self._conn:
+            self._write_compound_counts(counts)
+
+    def merge_compound_counts(self, counts: Mapping[str, int]) -> None:
+        rows = [(char, word, count) for word, count in counts.items() for char in set(word)]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT INTO compound_counts (char, word, count) VALUES (?, ?, ?)'
+                ' ON CONFLICT(char, word) DO UPDATE SET count = MAX(count, excluded.count)', rows)
+        metrics.incr('store.rows_written', len(rows))
+
+    def claim_segments(self, segments: Mapping[str, Optional[int]], generation: int,
+                       count: Callable[[Set[str]], Mapping[str, int]]) -> Set[str]:
+        claimed = set()
+        # The first write takes the database's write lock, so the checks below and the
+        # counts are not interleaved with another connection's claim
+        with self._lock, self._conn:
+            for fingerprint, previous in segments.items():
+                if previous is None:
+                    cursor = self._conn.execute(
+                        'INSERT OR IGNORE INTO segments (fingerprint, generation) VALUES (?, ?)',
+                        (fingerprint, generation))
+                else:
+                    cursor = self._conn.execute(
+                        'UPDATE segments SET generation = ? WHERE fingerprint = ? AND generation = ?',
+                        (generation, fingerprint, previous))
+                if cursor.rowcount:
+                    claimed.add(fingerprint)
+            counts = count(claimed)
+            if counts:
+                self._write_compound_counts(counts)
+        return claimed
+
+    def get_reviews(self, chars: Iterable[str]) -> Dict[str, Dict]:
+        return self._select('reviews', 'char', self.REVIEW_COLUMNS, chars)
+
+    def save_reviews(self, entries: Dict[str, Dict]) -> None:
+        # Review results do not change character data, so cached snapshots stay valid
+        self._insert('reviews', 'char', self.REVIEW_COLUMNS, entries, replace=True, bump_version=False)
+
+    def iter_reviews(self) -> Iterator[Tuple[str, Dict]]:
+        return self._iter_table('reviews', 'char', self.REVIEW_COLUMNS)
+
+    def version(self) -> Hashable:
+        # data_version only moves for commits made by other connections
+        with self._lock:
+            return self._writes, self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def migrate_json_to_sqlite(json_path: str = CHARS_JSON, db_path: str = CHARS_DB) -> int:
+    """Copy every entry of a chars.json file into an SQLite store, returns how many were added"""
+    store = SqliteCharStore(db_path)
+    try:
+        return store.add_new(read_json_chars(json_path))
+    finally:
+        store.close()
+
+
+def open_store(backend: Optional[str] = None) -> CharStore:
+    """Open the configured backend, migrating an existing chars.json into a new database"""
+    backend = backend or os.environ.get(BACKEND_ENV, DEFAULT_BACKEND)
+    if backend == 'json':
+        return JsonCharStore(CHARS_JSON)
+    if backend != 'sqlite':
+        raise ValueError(f"Unknown character store backend: {backend}")
+    if not os.path.exists(CHARS_DB) and os.path.exists(CHARS_JSON):
+        migrate_json_to_sqlite(CHARS_JSON, CHARS_DB)
+    return SqliteCharStore(CHARS_DB)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> CharStore:
+    """Return the process-wide character store"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = open_store()
+        return _store
+
+
+def close_store() -> None:
+    """Close the process-wide store so the next get_store() opens it afresh"""
+    global _store
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+            _store = None
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Manage the character store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate = subparsers.add_parser("migrate", help="copy chars.json into chars.db")
+    migrate.add_argument("--json", default=CHARS_JSON)
+    migrate.add_argument("--db", default=CHARS_DB)
+    export = subparsers.add_parser("export", help="write chars.db out as chars.json")
+    export.add_argument("--db", default=CHARS_DB)
+    export.add_argument("--json", default=CHARS_JSON)
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate":
+        added = migrate_json_to_sqlite(args.json, args.db)
+        print(f"Migrated {added} characters from {args.json} to {args.db}")
+    else:
+        store = SqliteCharStore(args.db)
+        try:
+            store.export_json(args.json)
+            print(f"Exported {len(store)} characters to {args.json}")
+        finally:
+            store.close()
+
+
+if __name__ == "__main__":
+    main()
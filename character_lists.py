@@ -1,60 +1,127 @@
 import json
 import os
-from typing import Dict, List, Set
+import threading
+from typing import Callable, Dict, FrozenSet, Iterable, List, Set
+from file_utils import atomic_open, file_lock, file_signature
+from instrumentation import metrics
 
-def load_character_lists() -> Dict[str, Set[str]]:
-    """Load saved character lists from file"""
-    if os.path.exists('character_lists.json') and os.path.getsize('character_lists.json') > 0:
-        with open('character_lists.json', 'r', encoding='utf-8') as f:
+LISTS_FILE = 'character_lists.json'
+LOCK_FILE = LISTS_FILE + '.lock'
+
+# Parsed lists shared by every caller in this process, refreshed when the file changes
+_cache: Dict[str, FrozenSet[str]] = {}
+_cache_signature = None
+_cache_lock = threading.Lock()
+
+def _read_lists_file() -> Dict[str, FrozenSet[str]]:
+    if os.path.exists(LISTS_FILE) and os.path.getsize(LISTS_FILE) > 0:
+        with open(LISTS_FILE, 'r', encoding='utf-8') as f:
             lists_dict = json.load(f)
             # Convert lists to sets for efficient operations
-            return {name: set(chars) for name, chars in lists_dict.items()}
-    return {"Favorites": set()}  # Default empty favorites list
+            return {name: frozenset(chars) for name, chars in lists_dict.items()}
+    return {"Favorites": frozenset()}  # Default empty favorites list
 
-def save_character_lists(lists_dict: Dict[str, Set[str]]) -> None:
-    """Save character lists to file"""
+def _cached_lists() -> Dict[str, FrozenSet[str]]:
+    """Return the parsed lists, re-reading the file only if its mtime changed"""
+    global _cache, _cache_signature
+    with _cache_lock:
+        signature = file_signature(LISTS_FILE)
+        if _cache_signature is None or signature != _cache_signature:
+            metrics.incr('lists.cache_misses')
+            _cache = _read_lists_file()
+            _cache_signature = signature
+        else:
+            metrics.incr('lists.cache_hits')
+        return _cache
+
+def _write_lists(lists_dict: Dict[str, Iterable[str]]) -> None:
+    """Atomically replace the lists file and refresh the cache; caller holds the file lock"""
+    global _cache, _cache_signature
     # Convert sets to lists for JSON serialization
-    json_dict = {name: list(chars) for name, chars in lists_dict.items()}
-    with open('character_lists.json', 'w', encoding='utf-8') as f:
+    json_dict = {name: sorted(chars) for name, chars in lists_dict.items()}
+    with atomic_open(LISTS_FILE) as f:
         json.dump(json_dict, f, ensure_ascii=False, indent=2)
+        metrics.incr('lists.bytes_written', f.tell())
+    with _cache_lock:
+        _cache = {name: frozenset(chars) for name, chars in lists_dict.items()}
+        _cache_signature = file_signature(LISTS_FILE)
+
+def _update_lists(mutate: Callable[[Dict[str, Set[str]]], bool]) -> None:
+    """Apply mutate to the latest lists under the cross-process lock, saving if it reports a change"""
+    with file_lock(LOCK_FILE):
+        # Re-read inside the lock so concurrent sessions never overwrite each other's changes
+        lists_dict = {name: set(chars) for name, chars in _read_lists_file().items()}
+        if mutate(lists_dict):
+            _write_lists(lists_dict)
+
+def load_character_lists() -> Dict[str, Set[str]]:
+    """Load saved character lists"""
+    return {name: set(chars) for name, chars in _cached_lists().items()}
+
+def save_character_lists(lists_dict: Dict[str, Set[str]]) -> None:
+    """Save character lists to file"""
+    with file_lock(LOCK_FILE):
+        _write_lists(lists_dict)
+
+def add_many_to_list(list_name: str, characters: Iterable[str]) -> None:
+    """Add several characters to a specified list in one write"""
+    characters = set(characters)
+
+    def mutate(lists_dict: Dict[str, Set[str]]) -> bool:
+        if list_name in lists_dict and characters <= lists_dict[list_name]:
+            return False
+        lists_dict.setdefault(list_name, set()).update(characters)
+        return True
+
+    _update_lists(mutate)
+
+def remove_many_from_list(list_name: str, characters: Iterable[str]) -> None:
+    """Remove several characters from a specified list in one write"""
+    characters = set(characters)
+
+    def mutate(lists_dict: Dict[str, Set[str]]) -> bool:
+        if list_name not in lists_dict or not characters & lists_dict[list_name]:
+            return False
+        lists_dict[list_name] -= characters
+        return True
+
+    _update_lists(mutate)
 
 def add_to_list(list_name: str, character: str) -> None:
     """Add a character to a specified list"""
-    lists_dict = load_character_lists()
-    if list_name not in lists_dict:
-        lists_dict[list_name] = set()
-    lists_dict[list_name].add(character)
-    save_character_lists(lists_dict)
+    add_many_to_list(list_name, [character])
 
 def remove_from_list(list_name: str, character: str) -> None:
     """Remove a character from a specified list"""
-    lists_dict = load_character_lists()
-    if list_name in lists_dict and character in lists_dict[list_name]:
-        lists_dict[list_name].remove(character)
-        save_character_lists(lists_dict)
+    remove_many_from_list(list_name, [character])
 
 def create_list(list_name: str) -> None:
     """Create a new character list"""
-    lists_dict = load_character_lists()
-    if list_name not in lists_dict:
+    def mutate(lists_dict: Dict[str, Set[str]]) -> bool:
+        if list_name in lists_dict:
+            return False
         lists_dict[list_name] = set()
-        save_character_lists(lists_dict)
+        return True
+
+    _update_lists(mutate)
 
 def delete_list(list_name: str) -> None:
     """Delete a character list"""
     if list_name == "Favorites":  # Protect the Favorites list
         return
-    lists_dict = load_character_lists()
-    if list_name in lists_dict:
+
+    def mutate(lists_dict: Dict[str, Set[str]]) -> bool:
+        if list_name not in lists_dict:
+            return False
         del lists_dict[list_name]
-        save_character_lists(lists_dict)
+        return True
+
+    _update_lists(mutate)
 
-def get_characters_in_list(list_name: str) -> Set[str]:
+def get_characters_in_list(list_name: str) -> FrozenSet[str]:
     """Get all characters in a specified list"""
-    lists_dict = load_character_lists()
-    return lists_dict.get(list_name, set())
+    return _cached_lists().get(list_name, frozenset())
 
 def get_all_lists() -> List[str]:
     """Get names of all available character lists"""
-    lists_dict = load_character_lists()
-    return list(lists_dict.keys()) 
\ No newline at end of file
+    return list(_cached_lists().keys())
@@ -0,0 +1,131 @@
+import array
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from cedict_index import CedictIndex, get_index
+from instrumentation import metrics
+
+# Transitions live in one flat dict keyed by (state << 21) | codepoint
+_CODEPOINT_BITS = 21
+
+
+class CompoundMatcher:
+    """Aho-Corasick automaton over a set of words, matched in one pass over the text"""
+
+    def __init__(self, words: Iterable[str]):
+        goto = {}
+        parent = array.array('i', [0])
+        label = array.array('i', [0])
+        depth = array.array('i', [0])
+        terminal = bytearray(1)
+
+        for word in words:
+            state = 0
+            for char in word:
+                key = state << _CODEPOINT_BITS | ord(char)
+                nxt = goto.get(key)
+                if nxt is None:
+                    nxt = len(depth)
+                    goto[key] = nxt
+                    parent.append(state)
+                    label.append(ord(char))
+                    depth.append(depth[state] + 1)
+                    terminal.append(0)
+                state = nxt
+            if state:
+                terminal[state] = 1
+
+        size = len(depth)
+        fail = array.array('i', bytes(4 * size))
+        dict_link = array.array('i', bytes(4 * size))
+        # Fail links only ever point to shallower states, so a depth-ordered pass is a BFS
+        for state in sorted(range(1, size), key=depth.__getitem__):
+            code = label[state]
+            target = fail[parent[state]]
+            while True:
+                nxt = goto.get(target << _CODEPOINT_BITS | code)
+                if nxt is not None and nxt != state:
+                    fail[state] = nxt
+                    break
+                if target == 0:
+                    break
+                target = fail[target]
+            link = fail[state]
+            dict_link[state] = link if terminal[link] else dict_link[link]
+
+        self._goto = goto
+        self._fail = fail
+        self._dict_link = dict_link
+        self._depth = depth
+        self._terminal = terminal
+
+    def __len__(self) -> int:
+        return len(self._depth)
+
+    def iter_matches(self, text: str, min_length: int = 1) -> Iterator[Tuple[int, str]]:
+        """Yield (start, word) for every word occurrence in text, ordered by end position"""
+        goto = self._goto
+        fail = self._fail
+        dict_link = self._dict_link
+        depth = self._depth
+        terminal = self._terminal
+        state = 0
+        for i, char in enumerate(text):
+            code = ord(char)
+            while True:
+                nxt = goto.get(state << _CODEPOINT_BITS | code)
+                if nxt is not None:
+                    state = nxt
+                    break
+                if state == 0:
+                    break
+                state = fail[state]
+            node = state if terminal[state] else dict_link[state]
+            while node:
+                length = depth[node]
+                if length >= min_length:
+                    yield i - length + 1, text[i - length + 1:i + 1]
+                node = dict_link[node]
+
+    def find_all(self, text: str, min_length: int = 1) -> Dict[str, List[int]]:
+        """Map each word found in text to its start positions"""
+        metrics.incr('matcher.chars_scanned', len(text))
+        positions = {}
+        for start, word in self.iter_matches(text, min_length):
+            positions.setdefault(word, []).append(start)
+        return positions
+
+    def prefixes(self, text: str, start: int) -> Iterator[int]:
+        """Yield the end position of every word that begins at text[start]"""
+        goto = self._goto
+        terminal = self._terminal
+        state = 0
+        for end in range(start, len(text)):
+            state = goto.get(state << _CODEPOINT_BITS | ord(text[end]))
+            if state is None:
+                return
+            if terminal[state]:
+                yield end + 1
+
+
+_matcher = None
+_matcher_version = None
+_matcher_lock = threading.Lock()
+
+
+def get_matcher(index: Optional[CedictIndex] = None) -> Optional[CompoundMatcher]:
+    """Return the shared matcher over all CEDICT headwords, rebuilt when the dictionary changes"""
+    global _matcher, _matcher_version
+    if index is None:
+        index = get_index()
+    if index is None:
+        return None
+    with _matcher_lock:
+        if _matcher is not None and _matcher_version == index.version:
+            metrics.incr('matcher.cache_hits')
+        else:
+            metrics.incr('matcher.cache_misses')
+            with metrics.timer('matcher.build'):
+                _matcher = CompoundMatcher(index.keys())
+            _matcher_version = index.version
+        return _matcher
@@ -0,0 +1,47 @@
+import array
+from typing import Dict, Iterable, Mapping
+
+from char_store import CharStore
+from instrumentation import metrics
+
+
+class CharTable:
+    """Immutable table assigning every stored character a small integer ID
+
+    IDs follow the store's insertion order, so they stay valid when the table is
+    rebuilt after new characters are added. Decks are arrays of IDs into this
+    table, letting every session share one copy of the characters.
+    """
+
+    def __init__(self, chars: Iterable[str]):
+        # One code point per character keeps the whole table in a single compact string
+        self.chars = ''.join(chars)
+        self._ids = {char: i for i, char in enumerate(self.chars)}
+
+    @classmethod
+    def from_store(cls, store: CharStore) -> 'CharTable':
+        with metrics.timer('deck.table_build'):
+            return cls(store.keys())
+
+    def __len__(self) -> int:
+        return len(self.chars)
+
+    def __getitem__(self, char_id: int) -> str:
+        return self.chars[char_id]
+
+    def id_of(self, char: str) -> int:
+        return self._ids[char]
+
+    def ids(self, chars: Iterable[str]) -> array.array:
+        """Sorted IDs of whichever of chars are in the table"""
+        ids = self._ids
+        return array.array('I', sorted(ids[char] for char in chars if char in ids))
+
+    def all_ids(self) -> array.array:
+        return array.array('I', range(len(self.chars)))
+
+
+def build_list_ids(table: CharTable, lists: Mapping[str, Iterable[str]]) -> Dict[str, array.array]:
+    """Precompute the member IDs of every character list"""
+    with metrics.timer('deck.list_ids_build'):
+        return {name: table.ids(chars) for name, chars in lists.items()}
@@ -0,0 +1,271 @@
+import argparse
+import csv
+import html
+import itertools
+import json
+import os
+import re
+import sys
+from typing import IO, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from char_store import CharStore, get_store
+from character_lists import get_all_lists, get_characters_in_list
+from file_utils import atomic_open
+from instrumentation import metrics
+from pinyin_engine import char_reading, full_pinyin, word_readings
+from processor import is_chinese_char
+from scheduler import flush_pending
+
+EXPORT_FORMATS = ('anki', 'tsv', 'csv', 'jsonl')
+# Entries read from the store or written to it per batch
+BATCH_SIZE = 500
+COLUMNS = ('char', 'pinyin', 'meaning', 'compounds')
+ANKI_COLUMNS = ('Character', 'Pinyin', 'Meaning', 'Compounds', 'Tags')
+
+# Compounds are joined into one field; tabs and newlines cannot appear inside a TSV field
+_COMPOUND_SEPARATORS = {'anki': '<br>', 'tsv': '<br>', 'csv': '\n'}
+_COMPOUND = re.compile(r'^(\S+) \[([^\]]*)\]: (.*)$', re.DOTALL)
+_EXTENSIONS = {'.jsonl': 'jsonl', '.csv': 'csv', '.tsv': 'tsv', '.txt': 'anki'}
+
+
+def format_for_path(path: str) -> str:
+    """Guess the export format from a file name"""
+    fmt = _EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if fmt is None:
+        raise ValueError(f"Cannot tell the format of {path}, use one of: {', '.join(EXPORT_FORMATS)}")
+    return fmt
+
+
+def iter_entries(store: CharStore, list_name: Optional[str] = None) -> Iterator[Tuple[str, Dict]]:
+    """Stream the store's character entries, only those in list_name if given"""
+    if list_name is None:
+        return store.items()
+    if list_name not in get_all_lists():
+        raise ValueError(f"Unknown character list: {list_name}")
+    members = get_characters_in_list(list_name)
+    return ((char, info) for char, info in store.items() if char in members)
+
+
+def compound_pinyin(word: str) -> str:
+    """Reading of a compound, from its own CEDICT entry when it has one"""
+    readings = word_readings(word)
+    return ' '.join(readings) if readings is not None else full_pinyin(word)
+
+
+def export_records(store: CharStore, entries: Iterable[Tuple[str, Dict]]) -> Iterator[Dict]:
+    """Export records with readings generated for every compound and the review state, a batch at a time"""
+    # Reviews still buffered by this process's scheduler belong in the export
+    flush_pending()
+    entries = iter(entries)
+    while True:
+        batch = list(itertools.islice(entries, BATCH_SIZE))
+        if not batch:
+            return
+        reviews = store.get_reviews(char for char, _ in batch)
+        for char, info in batch:
+            record = {
+                'char': char,
+                'pinyin': info.get('pinyin') or char_reading(char),
+                'meaning': info.get('meaning', ''),
+                'compounds': [dict(compound, pinyin=compound_pinyin(compound['word']))
+                              for compound in info.get('compounds', [])],
+                'dict_version': info.get('dict_version', ''),
+            }
+            if char in reviews:
+                record['review'] = reviews[char]
+            yield record
+        metrics.incr('export.records', len(batch))
+
+
+def _field(value: str) -> str:
+    return ' '.join(value.split())
+
+
+def _anki_field(value: str) -> str:
+    return html.escape(_field(value), quote=False)
+
+
+def format_compounds(compounds: List[Dict], fmt: str) -> str:
+    """One text field listing every compound as 'word [pinyin]: meaning'"""
+    items = (f"{compound['word']} [{compound['pinyin']}]: {compound['meaning']}" for compound in compounds)
+    if fmt == 'anki':
+        items = (_anki_field(item) for item in items)
+    elif fmt == 'tsv':
+        items = (_field(item) for item in items)
+    return _COMPOUND_SEPARATORS[fmt].join(items)
+
+
+def parse_compounds(field: str, fmt: str) -> List[Dict]:
+    """Inverse of format_compounds; occurrence counts are not part of tabular exports"""
+    compounds = []
+    for item in field.split(_COMPOUND_SEPARATORS[fmt]):
+        match = _COMPOUND.match(html.unescape(item) if fmt == 'anki' else item)
+        if match is not None:
+            compounds.append({'word': match.group(1), 'meaning': match.group(3)})
+    return compounds
+
+
+def write_records(records: Iterable[Dict], f: IO[str], fmt: str, tags: str = '') -> int:
+    """Write export records to an open text file, returns how many were written"""
+    count = 0
+    if fmt == 'jsonl':
+        for count, record in enumerate(records, start=1):
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        return count
+    if fmt == 'csv':
+        writer = csv.writer(f, lineterminator='\n')
+        writer.writerow(COLUMNS)
+        for count, record in enumerate(records, start=1):
+            writer.writerow([record['char'], record['pinyin'], record['meaning'],
+                             format_compounds(record['compounds'], fmt)])
+        return count
+    if fmt == 'anki':
+        # File headers understood by Anki's text importer (2.1.55 and later)
+        f.write('#separator:tab\n#html:true\n')
+        f.write('#columns:' + '\t'.join(ANKI_COLUMNS) + '\n')
+        f.write(f'#tags column:{len(ANKI_COLUMNS)}\n')
+        escape = _anki_field
+    else:
+        f.write('\t'.join(COLUMNS) + '\n')
+        escape = _field
+    for count, record in enumerate(records, start=1):
+        fields = [escape(record['char']), escape(record['pinyin']), escape(record['meaning']),
+                  format_compounds(record['compounds'], fmt)]
+        if fmt == 'anki':
+            fields.append(tags)
+        f.write('\t'.join(fields) + '\n')
+    return count
+
+
+@metrics.timed('export.write')
+def export_store(path: str, fmt: Optional[str] = None, list_name: Optional[str] = None,
+                 store: Optional[CharStore] = None) -> int:
+    """Stream the store, or one character list, into an export file ('-' for stdout)"""
+    fmt = fmt or format_for_path(path)
+    store = get_store() if store is None else store
+    records = export_records(store, iter_entries(store, list_name))
+    # Anki tags cannot contain spaces
+    tags = '_'.join(list_name.split()) if list_name else ''
+    if path == '-':
+        return write_records(records, sys.stdout, fmt, tags)
+    with atomic_open(path) as f:
+        return write_records(records, f, fmt, tags)
+
+
+def read_records(f: IO[str], fmt: str) -> Iterator[Dict]:
+    """Parse export records back out of an open text file, one line at a time"""
+    if fmt == 'jsonl':
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+        return
+    rows = csv.reader(f) if fmt == 'csv' else (line.rstrip('\n').split('\t') for line in f)
+    for row in rows:
+        if not row or not row[0] or row[0].startswith('#') or tuple(row[:len(COLUMNS)]) == COLUMNS:
+            continue
+        row += [''] * (len(COLUMNS) - len(row))
+        char, pinyin, meaning, compounds = row[:len(COLUMNS)]
+        if fmt == 'anki':
+            char, pinyin, meaning = html.unescape(char), html.unescape(pinyin), html.unescape(meaning)
+        yield {'char': char, 'pinyin': pinyin, 'meaning': meaning,
+               'compounds': parse_compounds(compounds, fmt) if compounds else []}
+
+
+def _store_entry(record: Dict) -> Dict:
+    return {
+        'pinyin': record.get('pinyin', ''),
+        'meaning': record.get('meaning', ''),
+        # Readings are generated on export, so only the stored compound fields are kept
+        'compounds': [{key: value for key, value in compound.items() if key != 'pinyin'}
+                      for compound in record.get('compounds', [])],
+        # Tabular exports do not carry it, so such entries count as stale until refreshed
+        'dict_version': record.get('dict_version', ''),
+    }
+
+
+def _is_char_key(value: object) -> bool:
+    return isinstance(value, str) and len(value) == 1 and is_chinese_char(value)
+
+
+@metrics.timed('export.import')
+def import_file(path: str, fmt: Optional[str] = None, store: Optional[CharStore] = None,
+                replace: bool = True) -> Tuple[int, int, int]:
+    """Bulk-load an export into the store in batches
+
+    Existing entries are overwritten unless replace is False. Records whose char is not
+    a single Chinese character are skipped. Returns the number of records read, entries
+    written and records skipped.
+    """
+    fmt = fmt or format_for_path(path)
+    store = get_store() if store is None else store
+    read = written = skipped = 0
+    if fmt == 'csv':
+        f = open(path, 'r', encoding='utf-8', newline='')
+    else:
+        f = open(path, 'r', encoding='utf-8')
+    with f:
+        records = read_records(f, fmt)
+        while True:
+            batch = list(itertools.islice(records, BATCH_SIZE))
+            if not batch:
+                break
+            read += len(batch)
+            # Store keys must be single characters, which deck.CharTable relies on
+            valid = [record for record in batch
+                     if isinstance(record, dict) and _is_char_key(record.get('char'))]
+            skipped += len(batch) - len(valid)
+            batch = valid
+            entries = {record['char']: _store_entry(record) for record in batch}
+            if not replace:
+                new = store.missing(entries)
+                entries = {char: entry for char, entry in entries.items() if char in new}
+            store.upsert(entries)
+            written += len(entries)
+            # Rankings come from the compound_counts table; tabular formats carry no counts
+            counts = {}
+            for entry in entries.values():
+                for compound in entry['compounds']:
+                    counts[compound['word']] = max(counts.get(compound['word'], 0), compound.get('count', 1))
+            store.merge_compound_counts(counts)
+            reviews = {record['char']: record['review'] for record in batch
+                       if 'review' in record and record['char'] in entries}
+            if reviews:
+                store.save_reviews(reviews)
+    metrics.incr('export.records_imported', read)
+    metrics.incr('export.records_skipped', skipped)
+    return read, written, skipped
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Export the character store to Anki, TSV, CSV or JSON Lines, "
+                                                 "or import such a file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export = subparsers.add_parser("export", help="write the store, or one list, to a file")
+    export.add_argument("path", help="output file, or - for standard output")
+    export.add_argument("--format", choices=EXPORT_FORMATS,
+                        help="defaults to the file extension (.txt is Anki, .tsv, .csv, .jsonl)")
+    export.add_argument("--list", dest="list_name", help="only export the characters in this list")
+    load = subparsers.add_parser("import", help="bulk-load an exported file into the store")
+    load.add_argument("path")
+    load.add_argument("--format", choices=EXPORT_FORMATS)
+    load.add_argument("--keep-existing", action="store_true",
+                      help="only add characters that are not in the store yet")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == "export":
+            fmt = args.format or ('jsonl' if args.path == '-' else format_for_path(args.path))
+            count = export_store(args.path, fmt, args.list_name)
+            if args.path != '-':
+                print(f"Exported {count} characters to {args.path}")
+        else:
+            read, written, skipped = import_file(args.path, args.format, replace=not args.keep_existing)
+            print(f"Imported {written} of {read} characters from {args.path}")
+            if skipped:
+                print(f"Warning: skipped {skipped} records that are not single Chinese characters")
+    except (FileNotFoundError, ValueError) as e:
+        print(f"Error: {e}")
+
+
+if __name__ == "__main__":
+    main()
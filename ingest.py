@@ -0,0 +1,261 @@
+import hashlib
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from cedict_index import get_index
+from char_store import CharStore
+from compound_matcher import get_matcher
+from instrumentation import metrics
+from segmenter import get_segmenter, is_han
+
+CHUNK_SIZE = 1 << 20  # characters per chunk
+TEXT_EXTENSIONS = ('.txt', '.srt', '.ass', '.ssa', '.vtt')
+PROGRESS_INTERVAL = 1.0  # seconds between progress lines
+
+# Paragraphs as (fingerprint, paragraph), keyed by the dictionary generation they were
+# analyzed at before, None for paragraphs never seen
+SegmentGroups = Dict[Optional[int], List[Tuple[str, str]]]
+
+
+class IngestResult:
+    """Characters and compound counts merged from any number of chunks"""
+
+    def __init__(self):
+        self.chars: Set[str] = set()
+        self.compound_counts: Counter = Counter()
+        self.word_counts: Counter = Counter()
+        self.total_chars = 0
+        self.files = 0
+
+    def merge(self, chars: Set[str], compound_counts: Dict[str, int],
+              word_counts: Dict[str, int], total_chars: int) -> None:
+        self.chars |= chars
+        self.compound_counts.update(compound_counts)
+        self.word_counts.update(word_counts)
+        self.total_chars += total_chars
+
+
+def split_segments(text: str) -> List[str]:
+    """Split text into the paragraphs that are fingerprinted and skipped independently"""
+    return [line for line in text.splitlines() if line.strip()]
+
+
+def segment_fingerprint(segment: str) -> str:
+    """Fingerprint a paragraph so it is only counted the first time it is analyzed"""
+    return hashlib.blake2b(segment.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def pending_segments(store: CharStore, text: str, generation: int) -> SegmentGroups:
+    """Paragraphs of text still to analyze, repeats included
+
+    Paragraphs analyzed at generation or a later one are skipped.
+    """
+    segments = [(segment_fingerprint(segment), segment) for segment in split_segments(text)]
+    seen = store.seen_segments(fingerprint for fingerprint, _ in segments)
+    groups = {}
+    skipped = 0
+    for fingerprint, segment in segments:
+        previous = seen.get(fingerprint)
+        if previous is not None and previous >= generation:
+            skipped += 1
+        else:
+            groups.setdefault(previous, []).append((fingerprint, segment))
+    metrics.incr('process.segments_skipped', skipped)
+    return groups
+
+
+def uncounted_compounds(store: CharStore, counts: Dict[str, int], previous: Optional[int]) -> Dict[str, int]:
+    """Leave out the compounds already counted for paragraphs analyzed at generation previous
+
+    Only headwords introduced by a later dictionary are new to such paragraphs.
+    """
+    if previous is None:
+        return counts
+    generations = store.headword_generations(counts)
+    return {word: count for word, count in counts.items() if generations.get(word, 0) > previous}
+
+
+def count_new_compounds(store: CharStore, groups: SegmentGroups,
+                        count_text: Callable[[str], Dict[str, int]]) -> Counter:
+    """Compound counts of grouped paragraphs, without those counted for them before"""
+    counts = Counter()
+    for previous, segments in groups.items():
+        if segments:
+            found = count_text('\n'.join(segment for _, segment in segments))
+            counts.update(uncounted_compounds(store, found, previous))
+    return counts
+
+
+def claim_segments(store: CharStore, groups: SegmentGroups, generation: int,
+                   counts: Dict[str, int], count_text: Callable[[str], Dict[str, int]]) -> Set[str]:
+    """Mark grouped paragraphs as analyzed and add their compound counts in one store transaction
+
+    counts cover every paragraph in groups; if another process claimed some of them
+    first, the rest are counted again on their own. Returns the claimed fingerprints.
+    """
+    previous = {fingerprint: seen_at for seen_at, segments in groups.items() for fingerprint, _ in segments}
+
+    def count(claimed: Set[str]) -> Dict[str, int]:
+        if len(claimed) == len(previous):
+            return counts
+        metrics.incr('process.segments_claimed_elsewhere', len(previous) - len(claimed))
+        return count_new_compounds(store, {
+            seen_at: [(fingerprint, segment) for fingerprint, segment in segments if fingerprint in claimed]
+            for seen_at, segments in groups.items()}, count_text)
+
+    return store.claim_segments(previous, generation, count)
+
+
+def iter_text_files(paths: Iterable[str]) -> Iterator[str]:
+    """Expand directories into the text files they contain, keeping explicit files as given"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(TEXT_EXTENSIONS):
+                        yield os.path.join(root, name)
+        elif os.path.exists(path):
+            yield path
+        else:
+            raise FileNotFoundError(2, "No such file or directory", path)
+
+
+def iter_block_chunks(blocks: Iterable[str], chunk_size: int) -> Iterator[str]:
+    """Regroup blocks of text into chunks of roughly chunk_size characters, cut at line breaks where possible"""
+    carry = ''
+    for block in blocks:
+        text = carry + block
+        # No dictionary word spans a line break, so compounds and segmentation
+        # stay exact; without one, fall back to the last non-Chinese character
+        cut = text.rfind('\n') + 1
+        if not cut:
+            cut = next((i + 1 for i in range(len(text) - 1, -1, -1) if not is_han(text[i])), 0)
+        if not cut or len(text) - cut > chunk_size:
+            cut = len(text)
+        yield text[:cut]
+        carry = text[cut:]
+    if carry:
+        yield carry
+
+
+def iter_chunks(path: str, chunk_size: int) -> Iterator[str]:
+    """Yield chunks of roughly chunk_size characters read from a file"""
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        yield from iter_block_chunks(iter(lambda: f.read(chunk_size), ''), chunk_size)
+
+
+def iter_text_chunks(text: str, chunk_size: int) -> Iterator[str]:
+    """Yield chunks of roughly chunk_size characters of an in-memory text"""
+    return iter_block_chunks((text[i:i + chunk_size] for i in range(0, len(text), chunk_size)), chunk_size)
+
+
+def count_chunk_compounds(chunk: str) -> Dict[str, int]:
+    """Occurrences of every multi-character CEDICT word in a chunk"""
+    compound_counts = Counter()
+    matcher = get_matcher()
+    if matcher is not None:
+        for _, word in matcher.iter_matches(chunk, min_length=2):
+            compound_counts[word] += 1
+    return compound_counts
+
+
+def analyze_chunk(chunk: str) -> Tuple[Set[str], Dict[str, int], Dict[str, int], int]:
+    """Collect characters, compound occurrences and segmented word counts for one chunk"""
+    word_counts = Counter()
+    segmenter = get_segmenter()
+    if segmenter is not None:
+        word_counts.update(token for token in segmenter.segment(chunk)
+                           if len(token) > 1 and is_han(token[0]))
+    return set(chunk), count_chunk_compounds(chunk), word_counts, len(chunk)
+
+
+def warm_worker() -> None:
+    """Process pool initializer shared by bulk ingestion and the HTTP service"""
+    # Open the mmap-ed index and build the automaton once per worker; under fork the
+    # parent's warm matcher and segmenter are inherited as-is
+    get_segmenter()
+
+
+class _Progress:
+    def __init__(self, stream=sys.stderr):
+        self.stream = stream
+        self.started = time.perf_counter()
+        self.last = self.started
+
+    def update(self, result: IngestResult, force: bool = False) -> None:
+        now = time.perf_counter()
+        if not force and now - self.last < PROGRESS_INTERVAL:
+            return
+        self.last = now
+        elapsed = max(now - self.started, 1e-9)
+        self.stream.write(f"\r{result.total_chars:,} chars from {result.files} files, "
+                          f"{result.total_chars / elapsed:,.0f} chars/s")
+        if force:
+            self.stream.write("\n")
+        self.stream.flush()
+
+
+def ingest_paths(paths: Iterable[str], workers: Optional[int] = None, chunk_size: int = CHUNK_SIZE,
+                 store: Optional[CharStore] = None, generation: int = 0) -> IngestResult:
+    """Stream every file under paths in bounded chunks, sharded across a process pool
+
+    With a store, paragraphs it analyzed at dictionary generation or later are left out.
+    Each chunk's paragraphs are marked as analyzed together with its compound counts as
+    soon as the chunk is done, so memory stays flat however many paragraphs there are.
+    """
+    result = IngestResult()
+    progress = _Progress()
+    if get_index() is None:
+        print("Warning: cedict_ts.u8 not found")
+    workers = workers or os.cpu_count() or 1
+
+    def tasks() -> Iterator[Tuple[str, Optional[SegmentGroups]]]:
+        for path in iter_text_files(paths):
+            result.files += 1
+            for chunk in iter_chunks(path, chunk_size):
+                if store is None:
+                    yield chunk, None
+                    continue
+                for previous, segments in pending_segments(store, chunk, generation).items():
+                    yield '\n'.join(segment for _, segment in segments), {previous: segments}
+
+    def merge(analysis: Tuple[Set[str], Dict[str, int], Dict[str, int], int],
+              groups: Optional[SegmentGroups]) -> None:
+        chars, compound_counts, word_counts, total_chars = analysis
+        if groups is not None:
+            compound_counts = uncounted_compounds(store, compound_counts, next(iter(groups)))
+            if not claim_segments(store, groups, generation, compound_counts, count_chunk_compounds):
+                # Another process analyzed these paragraphs meanwhile
+                return
+        result.merge(chars, compound_counts, word_counts, total_chars)
+
+    if workers == 1:
+        for task, groups in tasks():
+            merge(analyze_chunk(task), groups)
+            progress.update(result)
+    else:
+        get_segmenter()
+        with ProcessPoolExecutor(max_workers=workers, initializer=warm_worker) as pool:
+            # Only a few chunks are in flight at once so memory stays flat
+            pending = {}
+            for task, groups in tasks():
+                if len(pending) >= workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        merge(future.result(), pending.pop(future))
+                    progress.update(result)
+                pending[pool.submit(analyze_chunk, task)] = groups
+            for future in wait(pending).done:
+                merge(future.result(), pending[future])
+
+    progress.update(result, force=True)
+    # Worker processes keep their own metrics, so only the merged totals are recorded here
+    metrics.observe('ingest.total', time.perf_counter() - progress.started)
+    metrics.incr('ingest.chars', result.total_chars)
+    metrics.incr('ingest.files', result.files)
+    return result
@@ -0,0 +1,117 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Iterator, Optional
+
+# When set, snapshots are appended to this JSON lines file after each processing run
+METRICS_FILE_ENV = 'METRICS_FILE'
+
+
+class Metrics:
+    """Thread-safe registry of counters, stage timers and on-demand gauges"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._timers: Dict[str, list] = {}
+        self._gauges: Dict[str, Callable[[], object]] = {}
+
+    def incr(self, name: str, amount: float = 1) -> None:
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            stats = self._timers.setdefault(name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def timed(self, name: str) -> Callable:
+        """Decorator form of timer"""
+        def decorator(func: Callable) -> Callable:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def register_gauge(self, name: str, read: Callable[[], object]) -> None:
+        """Report the value of read() under name in every snapshot"""
+        with self._lock:
+            self._gauges[name] = read
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            counters = dict(self._counters)
+            timers = {
+                name: {'count': count, 'total_seconds': total, 'max_seconds': longest,
+                       'mean_seconds': total / count if count else 0.0}
+                for name, (count, total, longest) in self._timers.items()
+            }
+            gauges = dict(self._gauges)
+        return {
+            'counters': counters,
+            'timers': timers,
+            'gauges': {name: read() for name, read in gauges.items()},
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._timers.clear()
+
+    def to_jsonl(self, **labels) -> str:
+        """One JSON line per metric, tagged with a timestamp and any extra labels"""
+        snapshot = self.snapshot()
+        timestamp = time.time()
+        lines = []
+        for kind in ('counters', 'timers', 'gauges'):
+            for name, value in sorted(snapshot[kind].items()):
+                record = {'ts': timestamp, 'kind': kind[:-1], 'name': name, 'value': value}
+                record.update(labels)
+                lines.append(json.dumps(record, ensure_ascii=False, default=str))
+        return ''.join(line + '\n' for line in lines)
+
+    def export_jsonl(self, path: str, **labels) -> None:
+        """Append the current metrics to a JSON lines file"""
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(self.to_jsonl(**labels))
+
+    def format_report(self) -> str:
+        """Human-readable summary for the command line"""
+        snapshot = self.snapshot()
+        lines = ['Stage timings:']
+        for name, stats in sorted(snapshot['timers'].items(), key=lambda item: -item[1]['total_seconds']):
+            lines.append(f"  {name:<32} {stats['total_seconds'] * 1000:10.2f} ms  "
+                         f"x{stats['count']:<6} max {stats['max_seconds'] * 1000:.2f} ms")
+        lines.append('Counters:')
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append(f"  {name:<32} {value:,.0f}")
+        lines.append('Gauges:')
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append(f"  {name:<32} {value}")
+        return '\n'.join(lines)
+
+
+metrics = Metrics()
+
+
+def export_if_configured(**labels) -> Optional[str]:
+    """Append a snapshot to the file named by METRICS_FILE, if that variable is set"""
+    path = os.environ.get(METRICS_FILE_ENV)
+    if path:
+        metrics.export_jsonl(path, **labels)
+    return path
@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import json
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from server import DEFAULT_HOST, DEFAULT_PORT
+
+DEFAULT_SENTENCES = [
+    "我是中国人。",
+    "妈妈去银行。",
+    "我们一起学习中文。",
+    "他长大以后想当医生。",
+    "今天天气很好，我们去公园散步吧。",
+]
+
+
+class Client:
+    """Minimal HTTP/1.1 client that keeps one connection open across requests"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def request(self, method: str, path: str, payload: Optional[Dict] = None) -> Tuple[int, bytes]:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8') if payload is not None else b''
+        self._writer.write(
+            f'{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n'
+            f'Content-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+        await self._writer.drain()
+
+        status = int((await self._reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('transfer-encoding') == 'chunked':
+            parts = []
+            while True:
+                size = int(await self._reader.readline(), 16)
+                data = await self._reader.readexactly(size + 2)
+                if not size:
+                    break
+                parts.append(data[:-2])
+            content = b''.join(parts)
+        else:
+            content = await self._reader.readexactly(int(headers.get('content-length', 0)))
+        if headers.get('connection') == 'close':
+            await self.close()
+        return status, content
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+
+def make_payloads(texts: List[str], distinct: int) -> List[Dict]:
+    """Build distinct request bodies; fewer distinct bodies means more coalescing on the server"""
+    return [{'text': f'{texts[i % len(texts)]}{i // len(texts) or ""}'} for i in range(distinct)]
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+async def run_load(host: str, port: int, endpoint: str, payloads: List[Dict],
+                   requests: int, concurrency: int) -> Dict:
+    """Send requests POSTs from concurrency connections and collect latency statistics"""
+    latencies = []
+    errors = 0
+    counter = iter(range(requests))
+
+    async def worker() -> None:
+        nonlocal errors
+        client = Client(host, port)
+        try:
+            for i in counter:
+                started = time.perf_counter()
+                try:
+                    status, _ = await client.request('POST', endpoint, payloads[i % len(payloads)])
+                except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                    await client.close()
+                    errors += 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+                if status != 200:
+                    errors += 1
+        finally:
+            await client.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'endpoint': endpoint,
+        'requests': requests,
+        'concurrency': concurrency,
+        'distinct_payloads': len(payloads),
+        'errors': errors,
+        'seconds': elapsed,
+        'requests_per_second': requests / elapsed if elapsed else 0.0,
+        'latency_ms': {name: percentile(latencies, fraction) * 1000
+                       for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0))},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test a running analysis server")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--endpoint", default="/analyze",
+                        choices=["/analyze", "/pinyin", "/compounds", "/lookup"])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--distinct", type=int, default=100,
+                        help="number of different request bodies to cycle through")
+    parser.add_argument("--text-file", help="UTF-8 file whose non-empty lines are used as request texts")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    texts = DEFAULT_SENTENCES
+    if args.text_file:
+        with open(args.text_file, 'r', encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()] or DEFAULT_SENTENCES
+    payloads = make_payloads(texts, args.distinct)
+    if args.endpoint == '/lookup':
+        payloads = [{'word': payload['text'][:2]} for payload in payloads]
+
+    try:
+        results = asyncio.run(run_load(args.host, args.port, args.endpoint, payloads,
+                                       args.requests, args.concurrency))
+    except OSError as e:
+        print(f"Error: could not reach the server at {args.host}:{args.port} ({e})")
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    latency = results['latency_ms']
+    print(f"{results['requests']} requests to {results['endpoint']} over {results['concurrency']} connections "
+          f"in {results['seconds']:.2f} s: {results['requests_per_second']:,.0f} req/s, {results['errors']} errors")
+    print(f"Latency p50 {latency['p50']:.1f} ms, p90 {latency['p90']:.1f} ms, "
+          f"p99 {latency['p99']:.1f} ms, max {latency['max']:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
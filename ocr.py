@@ -0,0 +1,128 @@
+import hashlib
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+from file_utils import atomic_open
+
+OCR_CACHE_DIR = 'ocr_cache'
+OCR_LANG = 'chi_sim'
+OCR_WORKERS = 4
+MAX_DIMENSION = 2000  # pixels on the longest side when downscaling
+BINARIZE_THRESHOLD = 160
+
+# Tesseract location used on Windows installs
+TESSERACT_CMD = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
+
+# Takes a PIL image and a Tesseract language code
+Recognizer = Callable[[Any, str], str]
+
+
+class OcrResult(NamedTuple):
+    digest: str
+    text: str
+    error: Optional[str]
+    cached: bool
+
+
+def tesseract_recognize(image, lang: str = OCR_LANG) -> str:
+    """Run Tesseract on a PIL image"""
+    import pytesseract
+    # Configure pytesseract to use the installed Tesseract executable
+    if os.path.exists(TESSERACT_CMD):
+        pytesseract.pytesseract.tesseract_cmd = TESSERACT_CMD
+    return pytesseract.image_to_string(image, lang=lang)
+
+
+def preprocess_image(image, max_dimension: Optional[int] = None, binarize: bool = False):
+    """Optionally shrink an image and convert it to black and white before OCR"""
+    if max_dimension and max(image.size) > max_dimension:
+        image = image.copy()
+        image.thumbnail((max_dimension, max_dimension))
+    if binarize:
+        image = image.convert('L').point(lambda value: 255 if value > BINARIZE_THRESHOLD else 0, '1')
+    return image
+
+
+class OcrCache:
+    """Recognized text keyed by image content hash, kept in memory and on disk"""
+
+    def __init__(self, directory: Optional[str] = OCR_CACHE_DIR):
+        self.directory = directory
+        self._memory: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + '.txt')
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key in self._memory:
+                return self._memory[key]
+        if self.directory and os.path.exists(self._path(key)):
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                text = f.read()
+            with self._lock:
+                self._memory[key] = text
+            return text
+        return None
+
+    def put(self, key: str, text: str) -> None:
+        with self._lock:
+            self._memory[key] = text
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            with atomic_open(self._path(key)) as f:
+                f.write(text)
+
+
+_default_cache = OcrCache()
+
+
+def cache_key(data: bytes, lang: str, max_dimension: Optional[int], binarize: bool) -> str:
+    """Hash the image bytes together with every option that changes the recognized text"""
+    digest = hashlib.sha256(data)
+    digest.update(f'|{lang}|{max_dimension or 0}|{int(binarize)}'.encode('utf-8'))
+    return digest.hexdigest()
+
+
+def ocr_images(images: Sequence[bytes], lang: str = OCR_LANG, workers: int = OCR_WORKERS,
+               max_dimension: Optional[int] = None, binarize: bool = False,
+               recognize: Optional[Recognizer] = None,
+               cache: Optional[OcrCache] = None) -> List[OcrResult]:
+    """Recognize text in a batch of encoded images, in input order, on a bounded thread pool"""
+    recognize = recognize or tesseract_recognize
+    cache = cache if cache is not None else _default_cache
+    keys = [cache_key(data, lang, max_dimension, binarize) for data in images]
+    results: Dict[str, OcrResult] = {}
+
+    pending = {}
+    for key, data in zip(keys, images):
+        if key in results or key in pending:
+            continue  # same page uploaded twice in one batch
+        text = cache.get(key)
+        if text is not None:
+            results[key] = OcrResult(key, text, None, True)
+        else:
+            pending[key] = data
+
+    def run(key: str, data: bytes) -> OcrResult:
+        from PIL import Image
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                image = preprocess_image(image, max_dimension, binarize)
+                text = recognize(image, lang).strip()
+        except Exception as e:
+            return OcrResult(key, '', str(e), False)
+        cache.put(key, text)
+        return OcrResult(key, text, None, False)
+
+    if pending:
+        # Tesseract runs as a subprocess, so threads are enough to use several cores
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(pending)))) as pool:
+            for result in pool.map(lambda item: run(*item), pending.items()):
+                results[result.digest] = result
+
+    return [results[key] for key in keys]
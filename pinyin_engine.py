@@ -0,0 +1,133 @@
+import threading
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from cedict_index import get_index
+from instrumentation import metrics
+from segmenter import CJK_BLOCKS, HAN_RUN, get_segmenter
+
+SEGMENT_CACHE_SIZE = 8192
+WORD_CACHE_SIZE = 32768
+
+_TONE_MARKS = {
+    'a': 'āáǎà', 'e': 'ēéěè', 'i': 'īíǐì', 'o': 'ōóǒò', 'u': 'ūúǔù', 'ü': 'ǖǘǚǜ',
+}
+
+_table: Optional[Dict[str, str]] = None
+_table_lock = threading.Lock()
+
+
+def reading_table() -> Dict[str, str]:
+    """Default tone-marked reading for every character in the CJK blocks, built once"""
+    global _table
+    with _table_lock:
+        if _table is None:
+            from pypinyin.pinyin_dict import pinyin_dict
+            _table = {
+                chr(code): readings.split(',')[0]
+                for code, readings in pinyin_dict.items()
+                if any(start <= code <= end for start, end in CJK_BLOCKS)
+            }
+        return _table
+
+
+def char_reading(char: str) -> str:
+    """Default reading of a single character, the character itself if it has none"""
+    reading = reading_table().get(char)
+    if reading is not None:
+        return reading
+    from pypinyin import pinyin, Style
+    return pinyin(char, style=Style.TONE)[0][0]
+
+
+def numbered_to_tone_marks(syllable: str) -> str:
+    """Convert a CEDICT syllable such as 'lu:4' or 'hang2' to 'lǜ' or 'háng'"""
+    syllable = syllable.lower().replace('u:', 'ü').replace('v', 'ü')
+    if not syllable or not syllable[-1].isdigit():
+        return syllable
+    base, tone = syllable[:-1], int(syllable[-1])
+    if not 1 <= tone <= 4:
+        return base
+    # a and e always take the mark, then the o of ou, otherwise the last vowel
+    for vowel in ('a', 'e'):
+        if vowel in base:
+            position = base.index(vowel)
+            break
+    else:
+        if 'ou' in base:
+            position = base.index('o')
+        else:
+            vowels = [i for i, char in enumerate(base) if char in _TONE_MARKS]
+            if not vowels:
+                return base
+            position = vowels[-1]
+    return base[:position] + _TONE_MARKS[base[position]][tone - 1] + base[position + 1:]
+
+
+@lru_cache(maxsize=WORD_CACHE_SIZE)
+def _word_readings(word: str, version: str) -> Optional[Tuple[str, ...]]:
+    index = get_index()
+    if index is None:
+        return None
+    candidates = []
+    for entry in index.lookup(word):
+        syllables = entry.pinyin.split()
+        if len(syllables) == len(word):
+            candidates.append(syllables)
+    if not candidates:
+        return None
+    # Capitalized readings are proper nouns, so prefer a common-word reading
+    syllables = next((s for s in candidates if not s[0][:1].isupper()), candidates[0])
+    return tuple(numbered_to_tone_marks(syllable) for syllable in syllables)
+
+
+def word_readings(word: str) -> Optional[Tuple[str, ...]]:
+    """Per-character readings of a CEDICT word, None if the dictionary has none"""
+    index = get_index()
+    if index is None:
+        return None
+    return _word_readings(word, index.version)
+
+
+@lru_cache(maxsize=SEGMENT_CACHE_SIZE)
+def _segment_readings(segment: str, version: str) -> Tuple[str, ...]:
+    segmenter = get_segmenter()
+    table = reading_table()
+    readings = []
+    # Each word found by the segmenter decides the readings of its characters
+    for word in segmenter.segment_run(segment) if segmenter is not None else segment:
+        word_pinyin = _word_readings(word, version) if len(word) > 1 else None
+        if word_pinyin is not None:
+            readings.extend(word_pinyin)
+        else:
+            readings.extend(table.get(char) or char_reading(char) for char in word)
+    return tuple(readings)
+
+
+metrics.register_gauge('pinyin.word_cache', lambda: _word_readings.cache_info()._asdict())
+metrics.register_gauge('pinyin.segment_cache', lambda: _segment_readings.cache_info()._asdict())
+
+
+def segment_readings(segment: str) -> Tuple[str, ...]:
+    """Readings for a run of Chinese characters, chosen in the context of the words they form"""
+    index = get_index()
+    return _segment_readings(segment, index.version if index is not None else '')
+
+
+def text_pinyin(text: str) -> List[str]:
+    """One reading per Chinese character, with other text kept as whole runs like pypinyin"""
+    result = []
+    position = 0
+    for match in HAN_RUN.finditer(text):
+        if match.start() > position:
+            result.append(text[position:match.start()])
+        result.extend(segment_readings(match.group()))
+        position = match.end()
+    if position < len(text):
+        result.append(text[position:])
+    return result
+
+
+def full_pinyin(text: str) -> str:
+    """Space-separated pinyin for a whole text"""
+    return ' '.join(text_pinyin(text))
@@ -1,150 +1,402 @@
-import json
-import os
-from typing import Dict, List, Optional, Tuple
-from pypinyin import pinyin, Style
+import argparse
+import heapq
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
+from cedict_index import get_index
+from char_store import CharStore, get_store
+from compound_matcher import get_matcher
+from ingest import CHUNK_SIZE, claim_segments, count_new_compounds, ingest_paths, pending_segments
+from instrumentation import export_if_configured, metrics
+from pinyin_engine import char_reading, full_pinyin, numbered_to_tone_marks, word_readings
+from reverse_search import get_search_index, has_tones, parse_pinyin_query
+from segmenter import get_segmenter, is_han
 
 def load_chars_json() -> Dict:
-    """Load existing characters from chars.json"""
-    if os.path.exists('chars.json') and os.path.getsize('chars.json') > 0:
-        with open('chars.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
+    """Load all characters from the character store"""
+    return dict(get_store().items())
 
 def save_chars_json(chars_dict: Dict) -> None:
-    """Save characters to chars.json"""
-    with open('chars.json', 'w', encoding='utf-8') as f:
-        json.dump(chars_dict, f, ensure_ascii=False, indent=2)
+    """Save characters to the character store"""
+    get_store().upsert(chars_dict)
 
 def get_pinyin(char: str) -> str:
     """Get pinyin for a character"""
-    result = pinyin(char, style=Style.TONE)[0][0]
-    return result
+    return char_reading(char)
 
 def process_text_file(filename: str) -> str:
     """Read and process a text file, return its content"""
     with open(filename, 'r', encoding='utf-8') as f:
         return f.read()
 
-def find_compound_words(text: str) -> Dict[str, List[str]]:
-    """Find compound words for each character from cedict_ts.u8"""
+def find_compound_occurrences(text: str) -> Dict[str, List[int]]:
+    """Map every multi-character CEDICT word in text to its start positions"""
+    matcher = get_matcher()
+    if matcher is None:
+        print("Warning: cedict_ts.u8 not found")
+        return {}
+    return matcher.find_all(text, min_length=2)
+
+# Compounds stored per character; the rest are looked up from the index on demand
+COMPOUND_CAP = 10
+
+def find_compound_words(text: str) -> Dict[str, Dict[str, int]]:
+    """Find compound words for each character in a single pass over the text, with occurrence counts"""
     char_compounds = {}
     
-    try:
-        with open('cedict_ts.u8', 'r', encoding='utf-8') as f:
-            for line in f:
-                if line.startswith('#'):
-                    continue
-                    
-                parts = line.strip().split('/')
-                if not parts:
-                    continue
-                    
-                # Get the simplified character(s) from the line
-                simplified = parts[0].split()[1] if len(parts[0].split()) > 1 else ''
-                
-                # Skip single characters in dictionary (we'll handle those separately)
-                if len(simplified) < 2:
-                    continue
-                
-                # If this compound appears in our text
-                if simplified in text:
-                    # Add this compound to each character's compound list
-                    for char in simplified:
-                        if char not in char_compounds:
-                            char_compounds[char] = []
-                        if simplified not in char_compounds[char]:
-                            char_compounds[char].append(simplified)
-    
-    except FileNotFoundError:
-        print("Warning: cedict_ts.u8 not found")
+    for compound, positions in find_compound_occurrences(text).items():
+        # Add this compound to each character's compounds, keeping first-seen order
+        for char in compound:
+            char_compounds.setdefault(char, {})[compound] = len(positions)
     
     return char_compounds
 
+def rank_compounds(counts: Mapping[str, int], limit: Optional[int] = COMPOUND_CAP) -> List[str]:
+    """Most useful compounds first: by general word frequency, then by how often they were seen"""
+    segmenter = get_segmenter()
+    freqs = segmenter.freqs if segmenter is not None else {}
+    
+    def score(word: str) -> Tuple[int, int, int]:
+        return freqs.get(word, 0), counts.get(word, 0), -len(word)
+    
+    if limit is None:
+        return sorted(counts, key=score, reverse=True)
+    # Top-k selection with a heap instead of sorting every match
+    return heapq.nlargest(limit, counts, key=score)
+
+def dictionary_version() -> str:
+    """Version of the current CEDICT index, empty when the dictionary is missing"""
+    index = get_index()
+    return index.version if index is not None else ''
+
+def dictionary_generation(store: CharStore) -> int:
+    """Generation of the current dictionary in the store, 0 when the dictionary is missing"""
+    index = get_index()
+    if index is None:
+        return 0
+    return store.dictionary_generation(index.version, lambda: (key for key in index.keys() if len(key) > 1))
+
+def get_compound_meanings(compounds: Iterable[str], counts: Optional[Mapping[str, int]] = None) -> List[Dict]:
+    """Look up every CEDICT entry for the given compound words, with their counts if given"""
+    index = get_index()
+    if index is None:
+        return []
+    compound_meanings = []
+    for compound in compounds:
+        for entry in index.lookup(compound):
+            compound_meaning = {
+                'word': entry.simplified,
+                'meaning': '; '.join(entry.definitions)
+            }
+            if counts is not None:
+                compound_meaning['count'] = counts.get(compound, 0)
+            compound_meanings.append(compound_meaning)
+    return compound_meanings
+
+def build_compound_entries(counts: Mapping[str, int], known: Optional[Mapping[str, List[Dict]]] = None) -> List[Dict]:
+    """Stored compound entries for the top-ranked words, reusing already known entries"""
+    known = known or {}
+    entries = []
+    for word in rank_compounds(counts):
+        if word in known:
+            entries.extend(dict(entry, count=counts[word]) for entry in known[word])
+        else:
+            entries.extend(get_compound_meanings([word], counts))
+    return entries
+
+@lru_cache(maxsize=1024)
+def _all_compounds(char: str, version: str) -> Tuple[str, ...]:
+    index = get_index()
+    if index is None:
+        return ()
+    return tuple(rank_compounds(dict.fromkeys(index.words_containing(char), 0), limit=None))
+
+def all_compounds(char: str) -> Tuple[str, ...]:
+    """Every dictionary word containing char, most frequent first"""
+    return _all_compounds(char, dictionary_version())
+
+def compound_page(char: str, page: int, page_size: int = COMPOUND_CAP) -> List[Dict]:
+    """One page of all_compounds(char) with meanings, looked up only for that page"""
+    return get_compound_meanings(all_compounds(char)[page * page_size:(page + 1) * page_size])
+
+def search_dictionary(query: str, limit: int = 20, mode: str = 'auto', prefix: bool = False) -> List[Dict]:
+    """Find dictionary entries by English meaning or by pinyin
+
+    mode is 'english', 'pinyin' or 'auto', which treats queries with tones as pinyin
+    and otherwise tops up the English matches with pinyin ones
+    """
+    if mode not in ('auto', 'english', 'pinyin'):
+        raise ValueError(f"Unknown search mode: {mode}")
+    index = get_search_index()
+    if index is None:
+        return []
+    segmenter = get_segmenter()
+    freqs = segmenter.freqs if segmenter is not None else {}
+    with metrics.timer('search.query'):
+        if mode == 'auto' and has_tones(query) and parse_pinyin_query(query, prefix):
+            mode = 'pinyin'
+        if mode == 'pinyin':
+            results = index.search_pinyin(query, limit, prefix, freqs)
+        else:
+            results = index.search_english(query, limit, prefix)
+            if mode == 'auto' and len(results) < limit:
+                seen = {(r.entry.traditional, r.entry.simplified, r.entry.pinyin) for r in results}
+                extra = [r for r in index.search_pinyin(query, limit, prefix, freqs)
+                         if (r.entry.traditional, r.entry.simplified, r.entry.pinyin) not in seen]
+                results += extra[:limit - len(results)]
+    metrics.incr('search.queries')
+    return [{
+        'word': result.entry.simplified,
+        'traditional': result.entry.traditional,
+        'pinyin': ' '.join(numbered_to_tone_marks(syllable) for syllable in result.entry.pinyin.split()),
+        'meaning': '; '.join(result.entry.definitions),
+        'score': round(result.score, 3),
+    } for result in results]
+
 def get_meaning_from_cedict(char: str, compounds: List[str] = None) -> Tuple[str, List[str]]:
-    """Get the meaning of a character and its compounds from cedict_ts.u8"""
+    """Get the meaning of a character and its compounds from the CEDICT index"""
     meanings = []
     compound_meanings = []
     
-    try:
-        with open('cedict_ts.u8', 'r', encoding='utf-8') as f:
-            # First pass: find single character meaning
-            for line in f:
-                if line.startswith('#'):
-                    continue
-                parts = line.strip().split('/')
-                if not parts:
-                    continue
-                
-                entry_parts = parts[0].split()
-                if len(entry_parts) > 1:
-                    simplified = entry_parts[1]
-                    if simplified == char:
-                        meanings.extend([m for m in parts[1:-1] if m])
-                        break
-            
-            # Second pass: find compound meanings if any
-            if compounds:
-                f.seek(0)
-                for line in f:
-                    if line.startswith('#'):
-                        continue
-                    parts = line.strip().split('/')
-                    if not parts:
-                        continue
-                    
-                    entry_parts = parts[0].split()
-                    if len(entry_parts) > 1:
-                        simplified = entry_parts[1]
-                        if simplified in compounds:
-                            compound_meanings.append({
-                                'word': simplified,
-                                'meaning': '; '.join([m for m in parts[1:-1] if m])
-                            })
-    
-    except FileNotFoundError:
+    index = get_index()
+    if index is None:
         print("Warning: cedict_ts.u8 not found")
+    else:
+        # The first entry for a headword is its primary meaning
+        entries = index.lookup(char)
+        if entries:
+            meanings.extend(entries[0].definitions)
+        compound_meanings = get_compound_meanings(compounds or [])
     
     meaning = '; '.join(meanings) if meanings else "Meaning not found in CEDICT"
     return meaning, compound_meanings
 
-def process_chinese_text(text: str) -> None:
-    """Process Chinese text and update chars.json"""
-    chars_dict = load_chars_json()
+def is_chinese_char(char: str) -> bool:
+    """Check whether a character is in the CJK Unified Ideographs block"""
+    return '\u4e00' <= char <= '\u9fff'
+
+def build_char_entries(chars: Iterable[str], compounds_dict: Mapping[str, Mapping[str, int]]) -> Dict[str, Dict]:
+    """Create store entries for the given characters"""
+    version = dictionary_version()
+    entries = {}
+    for char in chars:
+        char_pinyin = get_pinyin(char)
+        meaning, _ = get_meaning_from_cedict(char)
+        
+        entries[char] = {
+            "pinyin": char_pinyin,
+            "meaning": meaning,
+            "compounds": build_compound_entries(compounds_dict.get(char, {})),
+            "dict_version": version
+        }
+    return entries
+
+def summarize_chars(text: str) -> Dict[str, int]:
+    """Occurrence counts of the Chinese characters in text, in order of first appearance"""
+    return Counter(char for char in text if is_chinese_char(char))
+
+def segment_text(text: str) -> List[str]:
+    """Split text into CEDICT words, keeping non-Chinese runs as single tokens"""
+    segmenter = get_segmenter()
+    if segmenter is None:
+        print("Warning: cedict_ts.u8 not found")
+        return list(text)
+    return segmenter.segment(text)
+
+def count_words(tokens: Iterable[str]) -> Dict[str, int]:
+    """Count the multi-character Chinese words among segmented tokens, in order of first appearance"""
+    return Counter(token for token in tokens if len(token) > 1 and is_han(token[0]))
+
+def build_word_entries(words: Iterable[str]) -> Dict[str, Dict]:
+    """Create word-level store entries with CEDICT readings and meanings"""
+    index = get_index()
+    version = dictionary_version()
+    entries = {}
+    for word in words:
+        dictionary_entries = index.lookup(word) if index is not None else []
+        readings = word_readings(word) or [get_pinyin(char) for char in word]
+        entries[word] = {
+            "pinyin": ' '.join(readings),
+            "meaning": ('; '.join(dictionary_entries[0].definitions)
+                        if dictionary_entries else "Meaning not found in CEDICT"),
+            "dict_version": version
+        }
+    return entries
+
+def analyze_text(text: str) -> Dict:
+    """Analyze text against the dictionary without reading or writing the store"""
+    chars = dict.fromkeys(char for char in text if is_chinese_char(char))
+    word_counts = count_words(segment_text(text))
+    word_entries = build_word_entries(word_counts)
+    return {
+        "pinyin": full_pinyin(text),
+        "chars": build_char_entries(chars, find_compound_words(text)),
+        "words": [dict(word=word, count=count, **word_entries[word]) for word, count in word_counts.items()],
+    }
+
+def count_compounds(text: str) -> Dict[str, int]:
+    """Occurrence counts of the multi-character CEDICT words in text"""
+    return {compound: len(positions) for compound, positions in find_compound_occurrences(text).items()}
+
+def _known_compounds(info: Dict) -> Dict[str, List[Dict]]:
+    known = {}
+    for compound in info.get('compounds', []):
+        known.setdefault(compound['word'], []).append(compound)
+    return known
+
+def _ranking_counts(info: Dict, counts: Mapping[str, int]) -> Dict[str, int]:
+    """Stored counts plus the compounds already in the entry, which migrated and imported entries keep without counts"""
+    ranked = {compound['word']: compound.get('count', 0) for compound in info.get('compounds', [])}
+    ranked.update(counts)
+    return ranked
+
+def update_store(store: CharStore, chars: Set[str], counted: Iterable[str],
+                 words: Iterable[str]) -> Tuple[int, int]:
+    """Add new characters and words, re-rank the compounds of counted words and rebuild stale entries
+
+    counted are the compounds whose counts were just added. Returns how many character
+    and word entries were added or changed.
+    """
+    version = dictionary_version()
+    with metrics.timer('process.store_lookup'):
+        existing = store.get_many(chars)
+    new_chars = chars - existing.keys()
+    metrics.incr('process.new_chars', len(new_chars))
     
-    # First find all compound words in the text
-    compounds_dict = find_compound_words(text)
+    with metrics.timer('process.build_char_entries'):
+        # Only characters of newly counted compounds can have their ranking change
+        counted = {char for compound in counted for char in compound}
+        stale = {char for char, info in existing.items() if info.get('dict_version') != version}
+        merged = (counted & existing.keys()) - stale
+        counts = store.get_compound_counts(new_chars | stale | merged)
+        entries = build_char_entries(new_chars, counts)
+        # Stale entries are rebuilt against the current dictionary from the stored counts
+        updates = build_char_entries(stale, {char: _ranking_counts(existing[char], counts.get(char, {}))
+                                             for char in stale})
+        for char in merged:
+            info = existing[char]
+            ranked = _ranking_counts(info, counts.get(char, {}))
+            updates[char] = dict(info, compounds=build_compound_entries(ranked, _known_compounds(info)))
+    metrics.incr('process.merged_chars', len(merged))
+    metrics.incr('process.stale_chars', len(stale))
     
-    # Process each unique character
-    for char in set(text):
-        if not '\u4e00' <= char <= '\u9fff':  # Skip non-Chinese characters
-            continue
-            
-        if char not in chars_dict:
-            char_pinyin = get_pinyin(char)
-            compounds = compounds_dict.get(char, [])
-            meaning, compound_meanings = get_meaning_from_cedict(char, compounds)
-            
-            # Create new entry
-            chars_dict[char] = {
-                "pinyin": char_pinyin,
-                "meaning": meaning,
-                "compounds": compound_meanings
-            }
+    words = set(words)
+    existing_words = store.get_words(words)
+    new_words = words - existing_words.keys()
+    stale_words = [word for word, info in existing_words.items() if info.get('dict_version') != version]
+    metrics.incr('process.new_words', len(new_words))
+    metrics.incr('process.stale_words', len(stale_words))
+    with metrics.timer('process.build_word_entries'):
+        word_entries = build_word_entries(new_words)
+        word_updates = build_word_entries(stale_words)
     
-    # Save updated dictionary
-    save_chars_json(chars_dict)
+    with metrics.timer('process.store_write'):
+        if entries:
+            store.add_new(entries)
+        if updates:
+            store.upsert(updates)
+        if word_entries:
+            store.add_new_words(word_entries)
+        if word_updates:
+            store.upsert_words(word_updates)
+    return len(entries) + len(updates), len(word_entries) + len(word_updates)
+
+def process_chinese_text(text: str) -> None:
+    """Process Chinese text and update the store from the paragraphs not analyzed with this dictionary before"""
+    metrics.incr('process.chars_in', len(text))
+    with metrics.timer('process.total'):
+        store = get_store()
+        generation = dictionary_generation(store)
+        groups = pending_segments(store, text, generation)
+        if not groups:
+            return
+        
+        # Repeated paragraphs are all kept, so every occurrence is counted
+        new_text = '\n'.join(segment for segments in groups.values() for _, segment in segments)
+        metrics.incr('process.chars_analyzed', len(new_text))
+        with metrics.timer('process.find_compounds'):
+            compound_counts = count_new_compounds(store, groups, count_compounds)
+        with metrics.timer('process.segment'):
+            word_counts = count_words(segment_text(new_text))
+        if not claim_segments(store, groups, generation, compound_counts, count_compounds):
+            # Another session analyzed the same paragraphs meanwhile
+            return
+        chars = {char for char in set(new_text) if is_chinese_char(char)}
+        update_store(store, chars, compound_counts, word_counts)
+
+def refresh_stale(batch_size: int = 500) -> Tuple[int, int]:
+    """Rebuild every stored entry built from an older dictionary version"""
+    store = get_store()
+    version = dictionary_version()
+    stale_chars = store.stale_chars(version)
+    for i in range(0, len(stale_chars), batch_size):
+        existing = store.get_many(stale_chars[i:i + batch_size])
+        counts = store.get_compound_counts(existing)
+        store.upsert(build_char_entries(existing, {char: _ranking_counts(info, counts.get(char, {}))
+                                                   for char, info in existing.items()}))
+    stale_words = store.stale_words(version)
+    for i in range(0, len(stale_words), batch_size):
+        store.upsert_words(build_word_entries(stale_words[i:i + batch_size]))
+    return len(stale_chars), len(stale_words)
+
+def ingest_corpus(paths: List[str], workers: int = None, chunk_size: int = CHUNK_SIZE) -> None:
+    """Stream files or directories through the worker pool and update the store once"""
+    store = get_store()
+    generation = dictionary_generation(store)
+    result = ingest_paths(paths, workers=workers, chunk_size=chunk_size, store=store, generation=generation)
+    chars = {char for char in result.chars if is_chinese_char(char)}
+    changed, changed_words = update_store(store, chars, result.compound_counts, result.word_counts)
+    print(f"Updated {changed} characters and {changed_words} words from {result.files} files")
 
-def main():
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Add the characters of Chinese text to the character store")
+    parser.add_argument("paths", nargs="*",
+                        help="files or directories to ingest (defaults to input.txt)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes (defaults to the CPU count)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE,
+                        help="characters read per chunk")
+    parser.add_argument("--refresh-stale", action="store_true",
+                        help="rebuild entries created from an older version of CEDICT")
+    parser.add_argument("--search", metavar="QUERY", default=None,
+                        help="search the dictionary by English meaning or pinyin instead of processing text")
+    parser.add_argument("--profile", action="store_true",
+                        help="print per-stage timings and counters when done")
+    parser.add_argument("--metrics-out", default=None,
+                        help="append the collected metrics to this JSON lines file")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
     input_file = "input.txt"
     
     try:
-        text = process_text_file(input_file)
-        process_chinese_text(text)
-        print("Processing completed successfully!")
-    except FileNotFoundError:
-        print(f"Error: {input_file} not found. Please create it with Chinese text.")
+        if args.search is not None:
+            for result in search_dictionary(args.search):
+                print(f"{result['word']}\t{result['pinyin']}\t{result['meaning']}")
+        elif args.refresh_stale:
+            refreshed, refreshed_words = refresh_stale()
+            print(f"Refreshed {refreshed} characters and {refreshed_words} words")
+        elif args.paths:
+            ingest_corpus(args.paths, workers=args.workers, chunk_size=args.chunk_size)
+        else:
+            text = process_text_file(input_file)
+            process_chinese_text(text)
+        if args.search is None:
+            print("Processing completed successfully!")
+    except FileNotFoundError as e:
+        if args.paths:
+            print(f"Error: {e.filename} not found.")
+        else:
+            print(f"Error: {input_file} not found. Please create it with Chinese text.")
     except Exception as e:
         print(f"An error occurred: {str(e)}")
+    
+    if args.profile:
+        print(metrics.format_report())
+    if args.metrics_out:
+        metrics.export_jsonl(args.metrics_out, source="processor")
+    export_if_configured(source="processor")
 
 if __name__ == "__main__":
     main()
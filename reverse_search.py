@@ -0,0 +1,445 @@
+import array
+import heapq
+import math
+import os
+import re
+import struct
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Sequence, Tuple
+
+from cedict_index import (
+    CEDICT_FILE, CedictEntry, IndexCache, ensure_compiled, hash_file, lower_bound, map_file, parse_cedict_line
+)
+from instrumentation import metrics
+
+SEARCH_INDEX_FILE = 'cedict_ts.rsx'
+
+SEARCH_MAGIC = b'CEDR'
+SEARCH_VERSION = 1
+
+# magic, format version, sha256 of source, source size, source mtime_ns,
+# document count, term count, posting count, average document length
+_HEADER = struct.Struct('=4sI32sQqIIId')
+_UINT = 'I'
+_SHORT = 'H'
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+# Matches through prefix expansion rank below matches of the whole word
+PREFIX_WEIGHT = 0.8
+MAX_PREFIX_TERMS = 50
+MAX_PINYIN_CANDIDATES = 2000
+
+STOPWORDS = frozenset(
+    'a an and as at be by for from in is it of on or the to with'.split())
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+# Pinyin readings and cross-references such as 记得[ji4 de5] are not English
+_BRACKETED = re.compile(r'\[[^\]]*\]')
+_SYLLABLE = re.compile(r'([a-z]+)([1-5])')
+_QUERY_PIECE = re.compile(r'([a-z]+)([0-5]?)')
+
+_MARKED_VOWELS = {
+    marked: (vowel, tone)
+    for vowel, marks in {'a': 'āáǎà', 'e': 'ēéěè', 'i': 'īíǐì', 'o': 'ōóǒò',
+                         'u': 'ūúǔù', 'v': 'ǖǘǚǜ'}.items()
+    for tone, marked in enumerate(marks, start=1)
+}
+
+
+class SearchResult(NamedTuple):
+    entry: CedictEntry
+    score: float
+
+
+@lru_cache(maxsize=1)
+def _numpy():
+    """NumPy if it is installed, imported on first use because importing it takes ~100 ms"""
+    try:
+        import numpy
+    except ImportError:  # postings are scored in a Python loop instead
+        return None
+    return numpy
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase English terms of a text, without stopwords"""
+    return [token for token in _TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def definition_terms(definitions: Sequence[str]) -> List[str]:
+    """Searchable terms of an entry's definitions; classifier notes are left out"""
+    terms = []
+    for definition in definitions:
+        if not definition.startswith('CL:'):
+            terms.extend(tokenize(_BRACKETED.sub(' ', definition)))
+    return terms
+
+
+def pinyin_keys(reading: str) -> Tuple[str, str]:
+    """Toneless and toned ASCII keys of a CEDICT reading, e.g. ('lvxing', 'lv3xing2')"""
+    toned = []
+    for syllable in reading.lower().replace('u:', 'v').split():
+        base = syllable.rstrip('012345')
+        if base.isalpha() and base.isascii():
+            tone = syllable[len(base):len(base) + 1]
+            toned.append(base + (tone if tone in ('1', '2', '3', '4') else '5'))
+    return ''.join(s[:-1] for s in toned), ''.join(toned)
+
+
+def _build_postings(source: str) -> Tuple[List[int], List[int], Dict[str, List[Tuple[int, int]]], List[Tuple[str, str, int]]]:
+    offsets = []
+    lengths = []
+    postings: Dict[str, List[Tuple[int, int]]] = {}
+    readings = []
+    offset = 0
+    with open(source, 'rb') as f:
+        for line in f:
+            entry = parse_cedict_line(line.decode('utf-8', errors='replace'))
+            if entry is not None:
+                doc = len(offsets)
+                offsets.append(offset)
+                terms = Counter(definition_terms(entry.definitions))
+                lengths.append(min(sum(terms.values()), 0xFFFF))
+                for term, tf in terms.items():
+                    postings.setdefault(term, []).append((doc, min(tf, 0xFFFF)))
+                toneless, toned = pinyin_keys(entry.pinyin)
+                if toneless:
+                    readings.append((toneless, toned, doc))
+            offset += len(line)
+    return offsets, lengths, postings, readings
+
+
+@metrics.timed('search.index_build')
+def build_search_index(source: str = CEDICT_FILE, index_path: str = SEARCH_INDEX_FILE) -> None:
+    """Compile an inverted index of the English definitions and readings in the CEDICT source"""
+    digest = hash_file(source)
+    stat = os.stat(source)
+    offsets, lengths, postings, readings = _build_postings(source)
+    terms = sorted(postings)
+    readings.sort()
+
+    term_offsets = array.array(_UINT, [0])
+    posting_starts = array.array(_UINT, [0])
+    posting_docs = array.array(_UINT)
+    posting_tfs = array.array(_SHORT)
+    term_blob = []
+    for term in terms:
+        encoded = term.encode('ascii')
+        term_blob.append(encoded)
+        term_offsets.append(term_offsets[-1] + len(encoded))
+        for doc, tf in postings[term]:
+            posting_docs.append(doc)
+            posting_tfs.append(tf)
+        posting_starts.append(len(posting_docs))
+
+    toneless_offsets = array.array(_UINT, [0])
+    toned_offsets = array.array(_UINT, [0])
+    reading_docs = array.array(_UINT)
+    for toneless, toned, doc in readings:
+        toneless_offsets.append(toneless_offsets[-1] + len(toneless))
+        toned_offsets.append(toned_offsets[-1] + len(toned))
+        reading_docs.append(doc)
+
+    average_length = sum(lengths) / len(lengths) if lengths else 0.0
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(SEARCH_MAGIC, SEARCH_VERSION, digest, stat.st_size, stat.st_mtime_ns,
+                             len(offsets), len(terms), len(posting_docs), average_length))
+        f.write(struct.pack('=I', len(readings)))
+        # 4-byte arrays first, then 2-byte arrays, then the key bytes
+        for values in (array.array(_UINT, offsets), term_offsets, posting_starts, posting_docs,
+                       toneless_offsets, toned_offsets, reading_docs,
+                       array.array(_SHORT, lengths), posting_tfs):
+            values.tofile(f)
+        f.write(b''.join(term_blob))
+        f.write(''.join(toneless for toneless, _, _ in readings).encode('ascii'))
+        f.write(''.join(toned for _, toned, _ in readings).encode('ascii'))
+        metrics.incr('search.index_bytes_written', f.tell())
+    os.replace(tmp_path, index_path)
+
+
+def ensure_search_index(source: str = CEDICT_FILE, index_path: str = SEARCH_INDEX_FILE) -> None:
+    """Build the search index if it is missing or the source file's hash has changed"""
+    ensure_compiled(source, index_path, _HEADER, SEARCH_MAGIC, SEARCH_VERSION, build_search_index)
+
+
+@lru_cache(maxsize=1)
+def pinyin_syllables() -> FrozenSet[str]:
+    """Every toneless syllable with ü written as v, from the character reading table"""
+    from pinyin_engine import reading_table
+    syllables = set()
+    for reading in reading_table().values():
+        syllables.add(''.join(_MARKED_VOWELS.get(char, (char, 0))[0] for char in reading.replace('ü', 'v')))
+    return frozenset(syllable for syllable in syllables if syllable.isascii() and syllable.isalpha())
+
+
+def _split_syllables(letters: str, allow_partial: bool) -> Optional[List[str]]:
+    """Split unspaced pinyin into the fewest syllables, optionally ending in a partial one"""
+    syllables = pinyin_syllables()
+    longest = 6
+    best: List[Optional[List[str]]] = [None] * (len(letters) + 1)
+    best[0] = []
+    for end in range(1, len(letters) + 1):
+        for start in range(max(0, end - longest), end):
+            if best[start] is not None and letters[start:end] in syllables:
+                if best[end] is None or len(best[start]) + 1 < len(best[end]):
+                    best[end] = best[start] + [letters[start:end]]
+    if best[-1] is not None or not allow_partial:
+        return best[-1]
+    # The last syllable is still being typed
+    for start in range(len(letters) - 1, max(-1, len(letters) - longest - 1), -1):
+        if best[start] is not None and any(s.startswith(letters[start:]) for s in syllables):
+            return best[start] + [letters[start:]]
+    return None
+
+
+def parse_pinyin_query(query: str, allow_partial: bool = False) -> Optional[List[Tuple[str, int]]]:
+    """Syllables of a pinyin query with their tones (0 when not given), None if it is not pinyin
+
+    Accepts tone marks, tone numbers or no tones, with or without spaces, and ü as v or u:
+    """
+    letters = []
+    for char in query.lower().replace('u:', 'v').replace('ü', 'v'):
+        vowel, tone = _MARKED_VOWELS.get(char, (char, 0))
+        letters.append((vowel, tone))
+    text = ''.join(vowel for vowel, _ in letters)
+    marks = [tone for _, tone in letters]
+    if not text.strip() or re.search(r"[^a-z0-5\s'-]", text):
+        return None
+
+    parsed = []
+    pieces = list(_QUERY_PIECE.finditer(text))
+    for n, piece in enumerate(pieces):
+        partial = allow_partial and n == len(pieces) - 1 and not piece.group(2)
+        syllables = _split_syllables(piece.group(1), partial)
+        if syllables is None:
+            return None
+        position = piece.start()
+        for syllable in syllables:
+            tone = max(marks[position:position + len(syllable)])
+            parsed.append([syllable, tone])
+            position += len(syllable)
+        if piece.group(2):
+            parsed[-1][1] = int(piece.group(2)) or 5
+    return [(syllable, tone) for syllable, tone in parsed]
+
+
+def has_tones(query: str) -> bool:
+    """Check whether a query carries pinyin tone marks or tone numbers"""
+    query = query.lower()
+    return any(char in _MARKED_VOWELS for char in query) or re.search(r'[a-zü:][0-5]', query) is not None
+
+
+def _matches_reading(query: Sequence[Tuple[str, int]], toned: str, prefix: bool) -> bool:
+    """Check a parsed query with tones against an entry's toned key, syllable by syllable"""
+    syllables = _SYLLABLE.findall(toned)
+    if len(syllables) < len(query) or (not prefix and len(syllables) != len(query)):
+        return False
+    for i, ((base, tone), (entry_base, entry_tone)) in enumerate(zip(query, syllables)):
+        if tone and tone != int(entry_tone):
+            return False
+        if base != entry_base and not (prefix and i == len(query) - 1 and entry_base.startswith(base)):
+            return False
+    return True
+
+
+class SearchIndex:
+    """Read-only view over a compiled search index and its CEDICT source"""
+
+    def __init__(self, source: str = CEDICT_FILE, index_path: str = SEARCH_INDEX_FILE):
+        self.source = source
+        self.index_path = index_path
+        self._index_map = map_file(index_path)
+        self._source_map = map_file(source)
+
+        header = _HEADER.unpack_from(self._index_map, 0)
+        self.digest = header[2]
+        n_docs, n_terms, n_postings = header[5:8]
+        self.average_length = header[8] or 1.0
+        n_readings, = struct.unpack_from('=I', self._index_map, _HEADER.size)
+        self._n_docs = n_docs
+        self._n_terms = n_terms
+        self._n_readings = n_readings
+
+        view = self._view = memoryview(self._index_map)
+        pos = _HEADER.size + 4
+        sections = {}
+        for name, fmt, count in (
+                ('doc_offsets', _UINT, n_docs), ('term_offsets', _UINT, n_terms + 1),
+                ('posting_starts', _UINT, n_terms + 1), ('posting_docs', _UINT, n_postings),
+                ('toneless_offsets', _UINT, n_readings + 1), ('toned_offsets', _UINT, n_readings + 1),
+                ('reading_docs', _UINT, n_readings), ('doc_lengths', _SHORT, n_docs),
+                ('posting_tfs', _SHORT, n_postings)):
+            size = count * array.array(fmt).itemsize
+            sections[name] = view[pos:pos + size].cast(fmt)
+            pos += size
+        self._sections = sections
+        self._terms_base = pos
+        self._toneless_base = self._terms_base + (sections['term_offsets'][-1] if n_terms else 0)
+        self._toned_base = self._toneless_base + (sections['toneless_offsets'][-1] if n_readings else 0)
+        self._arrays = None
+        np = _numpy()
+        if np is not None:
+            # Zero-copy views of the postings plus each document's BM25 length normalization
+            lengths = np.frombuffer(sections['doc_lengths'], dtype=np.uint16)
+            self._arrays = {
+                'docs': np.frombuffer(sections['posting_docs'], dtype=np.uint32),
+                'tfs': np.frombuffer(sections['posting_tfs'], dtype=np.uint16),
+                'norms': K1 * (1 - B + B * lengths / self.average_length),
+            }
+
+    @property
+    def version(self) -> str:
+        return self.digest.hex()[:16]
+
+    def __len__(self) -> int:
+        return self._n_docs
+
+    def _term(self, i: int) -> bytes:
+        offsets = self._sections['term_offsets']
+        return self._index_map[self._terms_base + offsets[i]:self._terms_base + offsets[i + 1]]
+
+    def _toneless(self, i: int) -> bytes:
+        offsets = self._sections['toneless_offsets']
+        return self._index_map[self._toneless_base + offsets[i]:self._toneless_base + offsets[i + 1]]
+
+    def _toned(self, i: int) -> str:
+        offsets = self._sections['toned_offsets']
+        return self._index_map[self._toned_base + offsets[i]:self._toned_base + offsets[i + 1]].decode('ascii')
+
+    def _term_range(self, term: str, prefix: bool) -> range:
+        key = term.encode('ascii', errors='ignore')
+        start = lower_bound(key, self._n_terms, self._term)
+        end = start
+        while end < self._n_terms and (self._term(end).startswith(key) if prefix else self._term(end) == key):
+            end += 1
+        return range(start, end)
+
+    def entry(self, doc: int) -> CedictEntry:
+        offset = self._sections['doc_offsets'][doc]
+        end = self._source_map.find(b'\n', offset)
+        if end == -1:
+            end = len(self._source_map)
+        return parse_cedict_line(self._source_map[offset:end].decode('utf-8', errors='replace'))
+
+    def _results(self, scored: List[Tuple[float, int]]) -> List[SearchResult]:
+        return [SearchResult(self.entry(doc), score) for score, doc in scored]
+
+    def search_english(self, query: str, limit: int = 20, prefix: bool = False) -> List[SearchResult]:
+        """Entries whose definitions best match the English query, ranked by BM25
+
+        With prefix the last query word also matches longer words starting with it.
+        """
+        terms = tokenize(query)
+        if not terms:
+            return []
+        sections = self._sections
+        starts = sections['posting_starts']
+        lengths = sections['doc_lengths']
+        n_docs = self._n_docs
+        # Each word is scored once; the word typed last stays last so it is the one expanded
+        unique = [term for term in dict.fromkeys(terms) if term != terms[-1]] + [terms[-1]]
+        weighted = []
+        for n, term in enumerate(unique):
+            if prefix and n == len(unique) - 1:
+                expansions = self._term_range(term, prefix=True)
+                if len(expansions) > MAX_PREFIX_TERMS:
+                    # Keep the expansions found in the most entries
+                    expansions = heapq.nlargest(MAX_PREFIX_TERMS, expansions, key=lambda i: starts[i + 1] - starts[i])
+                weighted.extend((i, 1.0 if self._term(i) == term.encode('ascii') else PREFIX_WEIGHT)
+                                for i in expansions)
+            else:
+                weighted.extend((i, 1.0) for i in self._term_range(term, prefix=False))
+
+        idfs = []
+        for i, weight in weighted:
+            df = starts[i + 1] - starts[i]
+            idfs.append((starts[i], starts[i + 1], weight * math.log(1 + (n_docs - df + 0.5) / (df + 0.5))))
+        metrics.incr('search.postings_scored', sum(end - start for start, end, _ in idfs))
+        if self._arrays is not None:
+            return self._results(self._score_numpy(idfs, limit))
+
+        scores: Dict[int, float] = {}
+        for start, end, idf in idfs:
+            docs = sections['posting_docs'][start:end].tolist()
+            tfs = sections['posting_tfs'][start:end].tolist()
+            for doc, tf in zip(docs, tfs):
+                norm = K1 * (1 - B + B * lengths[doc] / self.average_length)
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (K1 + 1) / (tf + norm)
+        top = heapq.nlargest(limit, ((score, -doc) for doc, score in scores.items()))
+        return self._results([(score, -doc) for score, doc in top])
+
+    def _score_numpy(self, idfs: List[Tuple[int, int, float]], limit: int) -> List[Tuple[float, int]]:
+        np = _numpy()
+        arrays = self._arrays
+        docs = []
+        scores = []
+        for start, end, idf in idfs:
+            term_docs = arrays['docs'][start:end]
+            tfs = arrays['tfs'][start:end].astype(np.float64)
+            docs.append(term_docs)
+            scores.append(idf * tfs * (K1 + 1) / (tfs + arrays['norms'][term_docs]))
+        if not docs:
+            return []
+        docs = np.concatenate(docs)
+        scores = np.concatenate(scores)
+        if len(idfs) > 1:
+            # Sum the contributions of every term per document
+            docs, inverse = np.unique(docs, return_inverse=True)
+            scores = np.bincount(inverse, weights=scores)
+        if len(scores) > limit:
+            # Everything tied with the limit-th score stays in, so ties go to the earlier entry as in the Python loop
+            keep = scores >= -np.partition(-scores, limit - 1)[limit - 1]
+            docs, scores = docs[keep], scores[keep]
+        return sorted(zip(scores.tolist(), docs.tolist()), key=lambda item: (-item[0], item[1]))[:limit]
+
+    def search_pinyin(self, query: str, limit: int = 20, prefix: bool = False,
+                      freqs: Optional[Dict[str, int]] = None) -> List[SearchResult]:
+        """Entries whose reading matches the pinyin query, with or without tones
+
+        Exact readings come before longer ones matched by prefix, then more frequent
+        words (by freqs) and shorter headwords first.
+        """
+        parsed = parse_pinyin_query(query, allow_partial=prefix)
+        if not parsed:
+            return []
+        key = ''.join(syllable for syllable, _ in parsed).encode('ascii')
+        toned_query = any(tone for _, tone in parsed)
+        start = lower_bound(key, self._n_readings, self._toneless)
+        candidates = []
+        i = start
+        while i < self._n_readings and len(candidates) < MAX_PINYIN_CANDIDATES:
+            toneless = self._toneless(i)
+            if toneless != key and not (prefix and toneless.startswith(key)):
+                break
+            # Without tones a query like xian matches both xian and xi'an
+            if not toned_query or _matches_reading(parsed, self._toned(i), prefix):
+                candidates.append((toneless == key, i))
+            i += 1
+
+        docs = self._sections['reading_docs']
+        entries = [(exact, self.entry(docs[i])) for exact, i in candidates]
+        freqs = freqs or {}
+        ranked = heapq.nsmallest(limit, range(len(entries)), key=lambda n: (
+            not entries[n][0], -freqs.get(entries[n][1].simplified, 0), len(entries[n][1].simplified), n))
+        return [SearchResult(entries[n][1], 1.0 if entries[n][0] else PREFIX_WEIGHT) for n in ranked]
+
+    def close(self) -> None:
+        # The NumPy views must go before the buffers they point into
+        self._arrays = None
+        for section in self._sections.values():
+            section.release()
+        self._view.release()
+        self._index_map.close()
+        self._source_map.close()
+
+
+_search_index_cache = IndexCache('search', ensure_search_index, SearchIndex)
+
+
+def get_search_index(source: str = CEDICT_FILE, index_path: str = SEARCH_INDEX_FILE) -> Optional[SearchIndex]:
+    """Return the process-wide search index, rebuilding it when the source file changes"""
+    return _search_index_cache.get(source, index_path)
@@ -0,0 +1,224 @@
+import array
+import atexit
+import heapq
+import random
+import threading
+import time
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Sequence, Set
+
+from char_store import CharStore, get_store
+from deck import CharTable
+from instrumentation import metrics
+
+DAY = 86400.0
+INITIAL_EASE = 2.5
+MIN_EASE = 1.3
+# A failed card comes back within the same study session
+RELEARN_DELAY = 600.0
+# Pending review results are written to the store in batches of this size,
+# or once this many seconds have passed since the last write
+FLUSH_EVERY = 20
+FLUSH_INTERVAL = 30.0
+
+# SM-2 quality grades offered by the flashcard buttons
+AGAIN, HARD, GOOD, EASY = 1, 3, 4, 5
+GRADES = {'Again': AGAIN, 'Hard': HARD, 'Good': GOOD, 'Easy': EASY}
+
+NOT_QUEUED = 0xFFFFFFFF
+
+
+class ReviewState(NamedTuple):
+    """Scheduling state of one card; due is a Unix timestamp, interval_days is in days"""
+    due: float = 0.0
+    interval_days: float = 0.0
+    ease: float = INITIAL_EASE
+    reps: int = 0
+    lapses: int = 0
+    last_review: float = 0.0
+
+
+NEW_CARD = ReviewState()
+
+
+def sm2_update(state: ReviewState, grade: int, now: float) -> ReviewState:
+    """Apply one SM-2 review with quality grade 0-5 and return the new state"""
+    ease = max(MIN_EASE, state.ease + 0.1 - (5 - grade) * (0.08 + (5 - grade) * 0.02))
+    if grade < 3:
+        return ReviewState(now + RELEARN_DELAY, 0.0, ease, 0, state.lapses + 1, now)
+    reps = state.reps + 1
+    if reps == 1:
+        interval = 1.0
+    elif reps == 2:
+        interval = 6.0
+    else:
+        interval = state.interval_days * ease
+    return ReviewState(now + interval * DAY, interval, ease, reps, state.lapses, now)
+
+
+class DueQueue:
+    """Min-heap of the cards in one deck ordered by due time
+
+    Cards are IDs into a shared CharTable. Entries are never updated in place: when a
+    card's state changes a new entry is pushed and the outdated one is discarded once
+    it reaches the top of the heap. Cards reviewed through another deck are re-queued
+    when their entry comes up.
+    """
+
+    def __init__(self, scheduler: 'Scheduler', table: CharTable, ids: Sequence[int],
+                 seed: Optional[int] = None):
+        self._scheduler = scheduler
+        self._table = table
+        self._lock = threading.Lock()
+        self._size = len(ids)
+        # New cards share due time 0, so a random permutation decides the order they are introduced in
+        permutation = array.array('I', range(len(ids)))
+        random.Random(seed).shuffle(permutation)
+        # Per-ID rank and due time of the live heap entry, NOT_QUEUED for cards outside the deck
+        self._ranks = array.array('I', [NOT_QUEUED]) * len(table)
+        self._queued = array.array('d', bytes(8 * len(table)))
+        self._heap = []
+        for card_id, rank in zip(ids, permutation):
+            due = scheduler.state(table[card_id]).due
+            self._ranks[card_id] = rank
+            self._queued[card_id] = due
+            self._heap.append((due, rank, card_id))
+        heapq.heapify(self._heap)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, card_id: int) -> bool:
+        return card_id < len(self._ranks) and self._ranks[card_id] != NOT_QUEUED
+
+    def push(self, card_id: int) -> None:
+        """Queue a card again at its current due time"""
+        if card_id in self:
+            with self._lock:
+                self._requeue(card_id)
+
+    def _requeue(self, card_id: int) -> None:
+        due = self._scheduler.state(self._table[card_id]).due
+        self._queued[card_id] = due
+        heapq.heappush(self._heap, (due, self._ranks[card_id], card_id))
+
+    def _pop_current(self) -> Optional[tuple]:
+        # Caller holds the lock
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            due, _, card_id = entry
+            if due != self._queued[card_id]:
+                continue  # superseded by a newer entry
+            if due != self._scheduler.state(self._table[card_id]).due:
+                self._requeue(card_id)
+                continue
+            return entry
+        return None
+
+    def window(self, size: int, now: Optional[float] = None, ahead: bool = False) -> List[int]:
+        """IDs of the next size cards due by now (or simply the next size cards if ahead), without removing them"""
+        now = time.time() if now is None else now
+        taken = []
+        with self._lock:
+            while len(taken) < size:
+                entry = self._pop_current()
+                if entry is None:
+                    break
+                if entry[0] > now and not ahead:
+                    heapq.heappush(self._heap, entry)
+                    break
+                taken.append(entry)
+            for entry in taken:
+                heapq.heappush(self._heap, entry)
+        metrics.incr('scheduler.window_cards', len(taken))
+        return [card_id for _, _, card_id in taken]
+
+    def next_due_time(self) -> Optional[float]:
+        """When the earliest card in the deck becomes due"""
+        with self._lock:
+            entry = self._pop_current()
+            if entry is None:
+                return None
+            heapq.heappush(self._heap, entry)
+            return entry[0]
+
+
+class Scheduler:
+    """SM-2 review states for every card, persisted to the store in batched writes"""
+
+    def __init__(self, store: CharStore, flush_every: int = FLUSH_EVERY):
+        self._store = store
+        self._flush_every = flush_every
+        self._lock = threading.RLock()
+        self._states: Dict[str, ReviewState] = {
+            card: ReviewState(**info) for card, info in store.iter_reviews()
+        }
+        self._pending: Dict[str, ReviewState] = {}
+        self._last_flush = time.monotonic()
+        self._reviewed: Set[str] = {card for card, state in self._states.items() if state.reps > 0}
+        self._reviewed_snapshot: Optional[FrozenSet[str]] = None
+
+    def state(self, card: str) -> ReviewState:
+        return self._states.get(card, NEW_CARD)
+
+    def reviewed(self) -> FrozenSet[str]:
+        """Cards passed at least once, including results not written to the store yet"""
+        with self._lock:
+            if self._reviewed_snapshot is None:
+                self._reviewed_snapshot = frozenset(self._reviewed)
+            return self._reviewed_snapshot
+
+    def queue(self, table: CharTable, ids: Sequence[int], seed: Optional[int] = None) -> DueQueue:
+        """Build a due queue over a deck of card IDs"""
+        with metrics.timer('scheduler.queue_build'):
+            return DueQueue(self, table, ids, seed)
+
+    def review(self, card: str, grade: int, now: Optional[float] = None) -> ReviewState:
+        """Record a review result and return the card's new state"""
+        now = time.time() if now is None else now
+        with self._lock:
+            state = sm2_update(self.state(card), grade, now)
+            self._states[card] = state
+            self._pending[card] = state
+            if (state.reps > 0) != (card in self._reviewed):
+                if state.reps > 0:
+                    self._reviewed.add(card)
+                else:
+                    self._reviewed.discard(card)
+                self._reviewed_snapshot = None
+            if (len(self._pending) >= self._flush_every
+                    or time.monotonic() - self._last_flush >= FLUSH_INTERVAL):
+                self.flush()
+        metrics.incr('scheduler.reviews')
+        return state
+
+    def flush(self) -> None:
+        """Write all pending review results to the store"""
+        with self._lock:
+            self._last_flush = time.monotonic()
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            with metrics.timer('scheduler.flush'):
+                self._store.save_reviews({card: state._asdict() for card, state in pending.items()})
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> Scheduler:
+    """Return the process-wide scheduler over the shared store"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(get_store())
+            atexit.register(_scheduler.flush)
+        return _scheduler
+
+
+def flush_pending() -> None:
+    """Write review results still buffered in this process, so readers of the store see them"""
+    with _scheduler_lock:
+        scheduler = _scheduler
+    if scheduler is not None:
+        scheduler.flush()
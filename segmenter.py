@@ -0,0 +1,120 @@
+import math
+import os
+import re
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from cedict_index import get_index
+from compound_matcher import CompoundMatcher, get_matcher
+from file_utils import file_signature
+from instrumentation import metrics
+
+# Optional frequency table, one "word count" pair per line (jieba's dict.txt layout works)
+WORD_FREQ_FILE = 'word_freq.txt'
+# CJK Extension A, CJK Unified Ideographs and CJK Compatibility Ideographs
+CJK_BLOCKS = ((0x3400, 0x4DBF), (0x4E00, 0x9FFF), (0xF900, 0xFAFF))
+HAN_RUN = re.compile('[%s]+' % ''.join(f'\\u{start:04x}-\\u{end:04x}' for start, end in CJK_BLOCKS))
+# Longest run of Chinese characters held back while streaming before it is cut
+MAX_PENDING_RUN = 1 << 16
+
+
+def is_han(char: str) -> bool:
+    """Check whether a character lies in one of the CJK ideograph blocks"""
+    code = ord(char)
+    return any(start <= code <= end for start, end in CJK_BLOCKS)
+
+
+def load_word_frequencies(path: str = WORD_FREQ_FILE) -> Dict[str, int]:
+    """Read a word frequency table, empty if the file does not exist"""
+    freqs = {}
+    if not os.path.exists(path):
+        return freqs
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[1].isdigit():
+                freqs[parts[0]] = int(parts[1])
+    return freqs
+
+
+class Segmenter:
+    """Splits text into CEDICT words along the most probable path through the word DAG"""
+
+    def __init__(self, matcher: CompoundMatcher, freqs: Optional[Dict[str, int]] = None):
+        self.matcher = matcher
+        self.freqs = freqs or {}
+        total = sum(self.freqs.values())
+        self._log_total = math.log(total) if total else 0.0
+
+    def _score(self, word: str) -> float:
+        if not self.freqs:
+            return -1.0  # no frequencies: every word costs the same, so fewer words win
+        return math.log(self.freqs.get(word, 1)) - self._log_total
+
+    def segment_run(self, run: str) -> List[str]:
+        """Segment a run of Chinese characters"""
+        n = len(run)
+        best = [0.0] * (n + 1)
+        route = [n] * (n + 1)
+        # Right-to-left dynamic programming; each position has at most max-word-length edges
+        for start in range(n - 1, -1, -1):
+            ends = set(self.matcher.prefixes(run, start))
+            ends.add(start + 1)
+            best[start], route[start] = max(
+                (self._score(run[start:end]) + best[end], end) for end in ends)
+        words = []
+        start = 0
+        while start < n:
+            words.append(run[start:route[start]])
+            start = route[start]
+        return words
+
+    def segment(self, text: str) -> List[str]:
+        """Segment text, keeping everything between Chinese runs as single tokens"""
+        metrics.incr('segmenter.chars_segmented', len(text))
+        return list(self.iter_segment([text]))
+
+    def iter_segment(self, chunks: Iterable[str]) -> Iterator[str]:
+        """Segment a stream of text chunks, holding back only the trailing Chinese run of each"""
+        pending = ''
+        for chunk in chunks:
+            text = pending + chunk
+            # A trailing run may continue in the next chunk, so it waits unless it is too long
+            run_start = len(text)
+            while run_start > 0 and is_han(text[run_start - 1]) and len(text) - run_start < MAX_PENDING_RUN:
+                run_start -= 1
+            cut = run_start if len(text) - run_start < MAX_PENDING_RUN else len(text)
+            yield from self._tokens(text[:cut])
+            pending = text[cut:]
+        if pending:
+            yield from self._tokens(pending)
+
+    def _tokens(self, text: str) -> Iterator[str]:
+        position = 0
+        for match in HAN_RUN.finditer(text):
+            if match.start() > position:
+                yield text[position:match.start()]
+            yield from self.segment_run(match.group())
+            position = match.end()
+        if position < len(text):
+            yield text[position:]
+
+
+_segmenter = None
+_segmenter_key = None
+_segmenter_lock = threading.Lock()
+
+
+def get_segmenter() -> Optional[Segmenter]:
+    """Return the shared segmenter, rebuilt when the dictionary or frequency table changes"""
+    global _segmenter, _segmenter_key
+    index = get_index()
+    if index is None:
+        return None
+    key = (index.version, file_signature(WORD_FREQ_FILE))
+    with _segmenter_lock:
+        if _segmenter is None or _segmenter_key != key:
+            with metrics.timer('segmenter.build'):
+                _segmenter = Segmenter(get_matcher(index), load_word_frequencies())
+            _segmenter_key = key
+        return _segmenter
@@ -0,0 +1,378 @@
+import argparse
+import asyncio
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+from urllib.parse import unquote, urlsplit
+
+from cedict_index import get_index
+from character_lists import add_many_to_list, delete_list, get_all_lists, get_characters_in_list, remove_many_from_list
+from ingest import iter_text_chunks, warm_worker
+from instrumentation import metrics
+from pinyin_engine import full_pinyin, reading_table
+from processor import analyze_text, find_compound_words, process_chinese_text, search_dictionary
+from reverse_search import get_search_index, pinyin_syllables
+from segmenter import get_segmenter
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+MAX_BODY = 64 << 20  # bytes
+MAX_HEADER_LINES = 100
+# Texts longer than this (in characters) are analyzed in chunks and streamed back as NDJSON
+STREAM_THRESHOLD = 100_000
+STREAM_CHUNK_SIZE = 20_000
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class HttpError(Exception):
+    """Raised by handlers to answer with an error status and message"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+class Request:
+    def __init__(self, method: str, path: str, version: str, headers: Dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    @property
+    def keep_alive(self) -> bool:
+        connection = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.0':
+            return connection == 'keep-alive'
+        return connection != 'close'
+
+    def json(self) -> Dict:
+        try:
+            payload = json.loads(self.body or b'{}')
+        except ValueError:
+            raise HttpError(400, "Request body is not valid JSON")
+        if not isinstance(payload, dict):
+            raise HttpError(400, "Request body must be a JSON object")
+        return payload
+
+    def text(self) -> str:
+        text = self.json().get('text')
+        if not isinstance(text, str):
+            raise HttpError(400, "Field 'text' must be a string")
+        return text
+
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Request]:
+    """Parse one HTTP/1.x request, None once the client has closed the connection"""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, version = line.decode('latin-1').split()
+    except ValueError:
+        raise HttpError(400, "Malformed request line")
+    headers = {}
+    for _ in range(MAX_HEADER_LINES):
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    else:
+        raise HttpError(400, "Too many headers")
+    try:
+        length = int(headers.get('content-length') or 0)
+    except ValueError:
+        raise HttpError(400, "Invalid Content-Length")
+    if length < 0:
+        raise HttpError(400, "Invalid Content-Length")
+    if length > MAX_BODY:
+        raise HttpError(413, f"Request body exceeds {MAX_BODY} bytes")
+    body = await reader.readexactly(length) if length else b''
+    return Request(method.upper(), unquote(urlsplit(target).path), version, headers, body)
+
+
+def _head(status: int, headers: Dict[str, str]) -> bytes:
+    lines = [f'HTTP/1.1 {status} {REASONS.get(status, "")}']
+    lines.extend(f'{name}: {value}' for name, value in headers.items())
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def send_json(writer: asyncio.StreamWriter, status: int, payload: object, keep_alive: bool) -> None:
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    writer.write(_head(status, {
+        'Content-Type': 'application/json; charset=utf-8',
+        'Content-Length': str(len(body)),
+        'Connection': 'keep-alive' if keep_alive else 'close',
+    }) + body)
+    await writer.drain()
+
+
+async def send_stream(writer: asyncio.StreamWriter, records: AsyncIterator[Dict], keep_alive: bool) -> None:
+    """Send each record as one NDJSON line using chunked transfer encoding"""
+    writer.write(_head(200, {
+        'Content-Type': 'application/x-ndjson; charset=utf-8',
+        'Transfer-Encoding': 'chunked',
+        'Connection': 'keep-alive' if keep_alive else 'close',
+    }))
+    async for record in records:
+        data = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+        writer.write(f'{len(data):x}\r\n'.encode('latin-1') + data + b'\r\n')
+        await writer.drain()
+    writer.write(b'0\r\n\r\n')
+    await writer.drain()
+
+
+Handler = Callable[[Request], Awaitable[object]]
+
+
+class AnalysisServer:
+    """HTTP/JSON front end to the analyzer with a shared index and a process worker pool"""
+
+    def __init__(self, workers: Optional[int] = None, stream_threshold: int = STREAM_THRESHOLD,
+                 stream_chunk_size: int = STREAM_CHUNK_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.stream_threshold = stream_threshold
+        self.stream_chunk_size = stream_chunk_size
+        self._pool: Optional[ProcessPoolExecutor] = None
+        # Identical requests that arrive while one is being computed share its result
+        self._inflight: Dict[Tuple[str, str], asyncio.Future] = {}
+        self._routes: Dict[Tuple[str, str], Handler] = {
+            ('GET', '/health'): self.health,
+            ('GET', '/metrics'): self.get_metrics,
+            ('POST', '/analyze'): self.analyze,
+            ('POST', '/pinyin'): self.pinyin,
+            ('POST', '/compounds'): self.compounds,
+            ('POST', '/lookup'): self.lookup,
+            ('POST', '/search'): self.search,
+            ('GET', '/lists'): self.lists,
+        }
+        self._list_routes: Dict[str, Callable[[Request, str], Awaitable[object]]] = {
+            'GET': self.get_list,
+            'POST': self.update_list,
+            'DELETE': self.remove_list,
+        }
+
+    def start_pool(self) -> None:
+        # Load the index, segmenter and pinyin table once here; forked workers inherit them warm
+        if get_index() is None:
+            print("Warning: cedict_ts.u8 not found")
+        get_segmenter()
+        reading_table()
+        # Searches are answered in this process from the mmap-ed search index
+        get_search_index()
+        pinyin_syllables()
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_worker)
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+    async def _run(self, func: Callable, *args) -> object:
+        return await asyncio.get_running_loop().run_in_executor(self._pool, func, *args)
+
+    async def _coalesced(self, key: Tuple[str, str], func: Callable, *args) -> object:
+        future = self._inflight.get(key)
+        if future is not None:
+            metrics.incr('server.coalesced')
+        else:
+            future = asyncio.ensure_future(self._run(func, *args))
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # A client that disconnects must not cancel the work others are waiting on
+        return await asyncio.shield(future)
+
+    async def health(self, request: Request) -> Dict:
+        index = get_index()
+        return {'status': 'ok', 'dictionary': index.version if index is not None else None,
+                'workers': self.workers}
+
+    async def get_metrics(self, request: Request) -> Dict:
+        return metrics.snapshot()
+
+    async def analyze(self, request: Request) -> object:
+        payload = request.json()
+        text = request.text()
+        if payload.get('save'):
+            # The store lives in this process, so saving runs on a thread rather than in the pool
+            await asyncio.get_running_loop().run_in_executor(None, process_chinese_text, text)
+        if payload.get('stream') or len(text) > self.stream_threshold:
+            return self._stream_analysis(text)
+        return await self._coalesced(('analyze', text), analyze_text, text)
+
+    async def _stream_analysis(self, text: str) -> AsyncIterator[Dict]:
+        pending = deque()
+        offset = 0
+        chunks = 0
+        try:
+            for chunk in iter_text_chunks(text, self.stream_chunk_size):
+                pending.append((offset, asyncio.ensure_future(self._run(analyze_text, chunk))))
+                offset += len(chunk)
+                # Keep every worker busy without queueing the whole text at once
+                if len(pending) >= self.workers * 2:
+                    chunk_offset, future = pending.popleft()
+                    chunks += 1
+                    yield dict(offset=chunk_offset, **await future)
+            while pending:
+                chunk_offset, future = pending.popleft()
+                chunks += 1
+                yield dict(offset=chunk_offset, **await future)
+            yield {'done': True, 'chunks': chunks, 'length': len(text)}
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    async def pinyin(self, request: Request) -> Dict:
+        text = request.text()
+        return {'pinyin': await self._coalesced(('pinyin', text), full_pinyin, text)}
+
+    async def compounds(self, request: Request) -> Dict:
+        text = request.text()
+        return {'compounds': await self._coalesced(('compounds', text), find_compound_words, text)}
+
+    async def lookup(self, request: Request) -> Dict:
+        word = request.json().get('word')
+        if not isinstance(word, str) or not word:
+            raise HttpError(400, "Field 'word' must be a non-empty string")
+        index = get_index()
+        entries = index.lookup(word) if index is not None else []
+        return {'word': word, 'entries': [entry._asdict() for entry in entries]}
+
+    async def search(self, request: Request) -> Dict:
+        payload = request.json()
+        query = payload.get('query')
+        if not isinstance(query, str) or not query.strip():
+            raise HttpError(400, "Field 'query' must be a non-empty string")
+        limit = payload.get('limit', 20)
+        if not isinstance(limit, int) or not 0 < limit <= 200:
+            raise HttpError(400, "Field 'limit' must be an integer from 1 to 200")
+        try:
+            results = search_dictionary(query, limit, payload.get('mode', 'auto'), bool(payload.get('prefix')))
+        except ValueError as e:
+            raise HttpError(400, str(e))
+        return {'query': query, 'results': results}
+
+    async def lists(self, request: Request) -> Dict:
+        return {'lists': get_all_lists()}
+
+    async def get_list(self, request: Request, name: str) -> Dict:
+        if name not in get_all_lists():
+            raise HttpError(404, f"No list named {name}")
+        return {'name': name, 'characters': sorted(get_characters_in_list(name))}
+
+    async def update_list(self, request: Request, name: str) -> Dict:
+        payload = request.json()
+        add = payload.get('add', [])
+        remove = payload.get('remove', [])
+        # A single non-string element would make the whole list file unsortable
+        if not all(isinstance(chars, (list, str)) and all(isinstance(char, str) and len(char) == 1 for char in chars)
+                   for chars in (add, remove)):
+            raise HttpError(400, "Fields 'add' and 'remove' must be lists of single characters")
+        loop = asyncio.get_running_loop()
+        # List writes take a file lock, so keep them off the event loop
+        if add or name not in get_all_lists():
+            await loop.run_in_executor(None, add_many_to_list, name, add)
+        if remove:
+            await loop.run_in_executor(None, remove_many_from_list, name, remove)
+        return {'name': name, 'characters': sorted(get_characters_in_list(name))}
+
+    async def remove_list(self, request: Request, name: str) -> Dict:
+        if name == "Favorites":
+            raise HttpError(400, "The Favorites list cannot be deleted")
+        await asyncio.get_running_loop().run_in_executor(None, delete_list, name)
+        return {'deleted': name}
+
+    def _route_label(self, request: Request) -> str:
+        # Per-route timers, without one entry per list name or unknown path
+        if (request.method, request.path) in self._routes:
+            return f'{request.method} {request.path}'
+        if request.path.startswith('/lists/'):
+            return f'{request.method} /lists/<name>'
+        return 'unrouted'
+
+    async def dispatch(self, request: Request) -> object:
+        handler = self._routes.get((request.method, request.path))
+        if handler is not None:
+            return await handler(request)
+        if request.path.startswith('/lists/') and len(request.path) > len('/lists/'):
+            handler = self._list_routes.get(request.method)
+            if handler is None:
+                raise HttpError(405, f"{request.method} is not allowed on {request.path}")
+            return await handler(request, request.path[len('/lists/'):])
+        if any(path == request.path for _, path in self._routes):
+            raise HttpError(405, f"{request.method} is not allowed on {request.path}")
+        raise HttpError(404, f"No route for {request.path}")
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    request = await read_request(reader)
+                except HttpError as e:
+                    await send_json(writer, e.status, {'error': e.message}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                metrics.incr('server.requests')
+                with metrics.timer(f'server.{self._route_label(request)}'):
+                    try:
+                        result = await self.dispatch(request)
+                    except HttpError as e:
+                        metrics.incr('server.errors')
+                        await send_json(writer, e.status, {'error': e.message}, request.keep_alive)
+                    except Exception as e:
+                        metrics.incr('server.errors')
+                        await send_json(writer, 500, {'error': str(e)}, request.keep_alive)
+                    else:
+                        if hasattr(result, '__aiter__'):
+                            await send_stream(writer, result, request.keep_alive)
+                        else:
+                            await send_json(writer, 200, result, request.keep_alive)
+                if not request.keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            # Failures after a streamed response has started can only end the connection
+            metrics.incr('server.errors')
+            print(f"Error while streaming a response: {e}")
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> None:
+        self.start_pool()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving on http://{host}:{port} with {self.workers} workers")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve text analysis, pinyin, lookups and lists over HTTP/JSON")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of analysis worker processes (defaults to the CPU count)")
+    parser.add_argument("--stream-threshold", type=int, default=STREAM_THRESHOLD,
+                        help="texts longer than this many characters are streamed back as NDJSON")
+    args = parser.parse_args(argv)
+
+    server = AnalysisServer(workers=args.workers, stream_threshold=args.stream_threshold)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        print("Server stopped")
+
+
+if __name__ == "__main__":
+    main()